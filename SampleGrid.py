@@ -1,28 +1,24 @@
 import numpy as np
 
 def SampleGrid(Setup):
+    x_values, y_values, z_values = grid_axes(Setup)
+
+    # One row per microphone containing the microphone x, y, z-coordinates (x fastest, then y, then z)
+    z, y, x = np.meshgrid(z_values, y_values, x_values, indexing='ij')
+    Setup['Observation']['Point'] = np.stack([x.ravel(), y.ravel(), z.ravel()], axis=1)
+
+def grid_axes(Setup):
     # Create x, y, and z-values for the grid
-    x_values = (np.arange(Setup['Observation']['xSamples']) * Setup['Observation']['xSamplingDistance'] - 
-                (Setup['Observation']['xSamples'] - 1) * Setup['Observation']['xSamplingDistance'] / 2 + 
+    x_values = (np.arange(Setup['Observation']['xSamples']) * Setup['Observation']['xSamplingDistance'] -
+                (Setup['Observation']['xSamples'] - 1) * Setup['Observation']['xSamplingDistance'] / 2 +
                 Setup['Observation']['Center'][0])
-                
-    y_values = (np.arange(Setup['Observation']['ySamples']) * Setup['Observation']['ySamplingDistance'] - 
-                (Setup['Observation']['ySamples'] - 1) * Setup['Observation']['ySamplingDistance'] / 2 + 
-                Setup['Observation']['Center'][1])
-                
-    z_values = (np.arange(Setup['Observation']['zSamples']) * Setup['Observation']['zSamplingDistance'] - 
-                (Setup['Observation']['zSamples'] - 1) * Setup['Observation']['zSamplingDistance'] / 2 + 
-                Setup['Observation']['Center'][2])
 
-    # Create a list to store the points
-    points = []
-
-    # Create a sub-struct for each microphone containing the microphone x, y, z-coordinates
-    for z in z_values:
-        for y in y_values:
-            for x in x_values:
-                points.append([x, y, z])
+    y_values = (np.arange(Setup['Observation']['ySamples']) * Setup['Observation']['ySamplingDistance'] -
+                (Setup['Observation']['ySamples'] - 1) * Setup['Observation']['ySamplingDistance'] / 2 +
+                Setup['Observation']['Center'][1])
 
-    Setup['Observation']['Point'] = points
+    z_values = (np.arange(Setup['Observation']['zSamples']) * Setup['Observation']['zSamplingDistance'] -
+                (Setup['Observation']['zSamples'] - 1) * Setup['Observation']['zSamplingDistance'] / 2 +
+                Setup['Observation']['Center'][2])
 
-    
+    return x_values, y_values, z_values
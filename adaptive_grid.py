@@ -0,0 +1,159 @@
+import numpy as np
+from SampleGrid import grid_axes
+from green_3d_freq_modal_response import eigenfunction_gradients, frequency_bins, modal_factors_z0, modal_mu_z0, select_modes_z0
+from graph_edges import _undirected
+
+# Number of positions whose gradients are evaluated at once, to bound the [nPos, nFreq * sPos] temporaries
+CHUNK_SIZE = 1024
+
+def adaptive_grid(setup, freq_lim=400, tolerance=0.05, initial=4, points_per_wavelength=None, bins=None, margin=None):
+    """
+    Non-uniform receiver positions that are refined where the response varies the most, and
+    the edges between neighbouring receivers.
+
+    The extent of the SampleGrid grid of the setup is covered by a quadtree of rectangular
+    cells, starting from about initial cells along the longer side. A cell is split into four as
+    long as the estimated error of interpolating the response linearly across it, relative to
+    the RMS of its spatially varying part over the room and the evaluated frequencies, exceeds tolerance at
+    any of these frequencies and sources. Weak frequencies thus need fewer receivers than
+    strong ones. The error is estimated as h^2 / 8 * |H''| with h the longer cell side, and
+    the second derivative H'' from the change of the analytic gradient of the modal sum between
+    the center and the corners of the cell. Only frequencies up to freq_lim are evaluated;
+    above it the response is the rolloff of the same modes.
+
+    Cells are not split below a size of c / freq_lim / points_per_wavelength, a fraction of the
+    shortest wavelength of the modes included in the solution. By default points_per_wavelength
+    is 2 * pi / sqrt(8 * tolerance), where a plane wave of RMS amplitude at freq_lim meets
+    tolerance, so the tolerance can be met everywhere except at the strongest peaks of the
+    field. For the default tolerance 0.05 that is about 10 receivers per wavelength, close to
+    the 8.6 of the 0.1 m equidistant grid at 400 Hz; the receivers are only that dense where
+    the strong frequencies vary the most.
+
+    The receivers are the corners of the leaf cells, ordered by y and then x. Each receiver is
+    connected to its neighbours along the cell sides, so the edges equal those of grid_edges
+    with connectivity 4 where the cells are uniform.
+
+    Parameters:
+    - setup: Dictionary containing the configuration and parameters
+    - freq_lim: Highest eigenfunction resonance frequency included in the calculations
+    - tolerance: Largest estimated interpolation error within a cell, relative to the RMS response
+    - initial: Number of initial cells along the longer side of the grid
+    - points_per_wavelength: Receivers per shortest wavelength at the finest refinement, derived
+      from tolerance if None
+    - bins: Optional indices of the solution frequencies the refinement is based on (see
+      frequency_bins). Those above freq_lim are left out
+    - margin: If given, only modes resonating within margin [Hz] of the evaluated frequencies are included
+
+    Returns:
+    - Setup: Copy of setup with the receiver positions in Observation 'Point' (size = [rPos, 3])
+      and Observation 'Adaptive' set
+    - edges: Source and target receiver indices, listed in both directions (size = [2, nEdges])
+    """
+    if setup['Observation']['zSamples'] != 1:
+        raise ValueError('Adaptive refinement requires a single grid layer (zSamples = 1).')
+    x_values, y_values, z_values = grid_axes(setup)
+    origin = np.array([x_values[0], y_values[0]])
+    extent = np.array([x_values[-1], y_values[-1]]) - origin
+
+    # Number of refinement levels, and initial cells of about equal size along both axes such
+    # that the finest cells are just below h_min
+    if tolerance <= 0:
+        raise ValueError(f'Invalid tolerance {tolerance}. Should be positive.')
+    if points_per_wavelength is None:
+        points_per_wavelength = 2 * np.pi / np.sqrt(8 * tolerance)
+    h_min = setup['Ambient']['c'] / freq_lim / points_per_wavelength
+    levels = max(0, int(np.round(np.log2(extent.max() / initial / h_min))))
+    counts = np.maximum(1, np.ceil(extent / (h_min * 2 ** levels))).astype(int)
+
+    # Frequencies up to freq_lim
+    n_lim = int(np.floor(freq_lim * setup['Duration'])) + 1
+    bins = np.arange(n_lim) if bins is None else frequency_bins(setup, bins=bins)
+    bins = bins[bins < n_lim]
+
+    # Modal coefficients of the response, H(r) = Psi_r(r) @ weights, relative to its RMS over
+    # the room and the frequencies of each source
+    dims = setup['Room']['Dim']
+    modes = select_modes_z0(freq_lim, setup, bins, margin)
+    modal_numbers, scale, psi_s = modal_factors_z0(setup, modes)
+    mu = modal_mu_z0(setup, modes, bins)
+    weights = mu[:, :, None] * psi_s[:, None, :]
+    # The spatially uniform (0, 0) mode has no gradient and is left out of the RMS; below the
+    # highpass it would otherwise outweigh all other modes
+    varying = modes['mode_type'] > 0
+    rms = np.sqrt((weights[varying] ** 2).sum(axis=0).mean(axis=0) / np.prod(dims))
+    weights = (weights / np.where(rms > 0, rms, 1)).reshape(len(modes), -1)
+
+    # Refine level by level; cells are (ix, iy) indices on the lattice of their level
+    cells = np.stack(np.meshgrid(np.arange(counts[0]), np.arange(counts[1]), indexing='ij'), axis=-1).reshape(-1, 2)
+    leaves = []
+    for level in range(levels + 1):
+        size = extent / (counts * 2 ** level)
+        if level == levels or not len(cells):
+            leaves.append(cells * 2 ** (levels - level))
+            break
+        refine = _variation(origin + (cells + 0.5) * size, size, modal_numbers, dims[:2], scale, weights) > tolerance
+        leaves.append(cells[~refine] * 2 ** (levels - level))
+        cells = (cells[refine, None, :] * 2 + [[0, 0], [1, 0], [0, 1], [1, 1]]).reshape(-1, 2)
+
+    # Leaf cells on the finest lattice, as [x0, y0, x1, y1]
+    steps = np.concatenate([np.full(len(cells), 2 ** (levels - level)) for level, cells in enumerate(leaves)])
+    corners = np.concatenate(leaves)
+    boxes = np.concatenate([corners, corners + steps[:, None]], axis=1)
+
+    # Receivers at the unique cell corners, y-major like SampleGrid
+    width = counts[0] * 2 ** levels + 1
+    keys = np.unique(boxes[:, [1, 3, 1, 3]] * width + boxes[:, [0, 0, 2, 2]])
+    lattice = np.stack([keys % width, keys // width], axis=1)
+    points = origin + lattice * extent / (counts * 2 ** levels)
+
+    Setup = {**setup, 'Observation': {**setup['Observation'], 'Adaptive': True,
+                                      'Point': np.column_stack([points, np.full(len(points), z_values[0])])}}
+    return Setup, _quadtree_edges(keys, boxes, width)
+
+def _variation(centers, size, modal_numbers, dims, scale, weights):
+    """
+    Estimated error of interpolating the normalized response linearly across cells of the
+    given size, h^2 / 8 * |H''|, with the second derivative taken as the largest change of the
+    gradient between the center and a corner of the cell over half the cell diagonal.
+    """
+    offsets = np.array([[0, 0], [-0.5, -0.5], [0.5, -0.5], [-0.5, 0.5], [0.5, 0.5]]) * size
+    variation = np.empty(len(centers))
+    chunk = max(1, CHUNK_SIZE // len(offsets))
+    for start in range(0, len(centers), chunk):
+        positions = (centers[start:start + chunk, None, :] + offsets).reshape(-1, 2)
+        gradients = eigenfunction_gradients(positions, modal_numbers, dims, scale) @ weights
+        gradients = gradients.reshape(2, -1, len(offsets), weights.shape[1])
+        change = np.sqrt(((gradients[:, :, 1:] - gradients[:, :, :1]) ** 2).sum(axis=0))
+        variation[start:start + chunk] = change.max(axis=(1, 2), initial=0)
+    return size.max() ** 2 / 8 * variation / (np.hypot(*size) / 2)
+
+def _quadtree_edges(keys, boxes, width):
+    """
+    Edges between consecutive receivers along the sides of the leaf cells. keys are the sorted
+    lattice keys iy * width + ix of the receivers and boxes the leaf cells [x0, y0, x1, y1].
+    """
+    # Sides along x, at rows y0 and y1 of each cell, between columns x0 and x1
+    rows = np.concatenate([boxes[:, 1], boxes[:, 3]])
+    starts = np.searchsorted(keys, rows * width + np.tile(boxes[:, 0], 2))
+    stops = np.searchsorted(keys, rows * width + np.tile(boxes[:, 2], 2))
+    x_sources = _ranges(starts, stops)
+
+    # Sides along y, with the receivers ordered by x and then y
+    order = np.lexsort((keys // width, keys % width))
+    height = keys.max() // width + 1
+    transposed = (keys % width) * height + keys // width
+    columns = np.concatenate([boxes[:, 0], boxes[:, 2]])
+    starts = np.searchsorted(transposed[order], columns * height + np.tile(boxes[:, 1], 2))
+    stops = np.searchsorted(transposed[order], columns * height + np.tile(boxes[:, 3], 2))
+    y_sources = _ranges(starts, stops)
+
+    return _undirected(np.concatenate([x_sources, order[y_sources]]),
+                       np.concatenate([x_sources + 1, order[y_sources + 1]]))
+
+def _ranges(starts, stops):
+    """
+    Concatenation of arange(start, stop) for all pairs.
+    """
+    lengths = stops - starts
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets
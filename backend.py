@@ -0,0 +1,194 @@
+import importlib.util
+import os
+import sys
+import numpy as np
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:  # Without threadpoolctl the BLAS threads are only set for new processes
+    threadpool_limits = None
+
+# Environment variables read by the BLAS/OpenMP runtimes when numpy is imported
+BLAS_THREAD_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+class NumpyBackend:
+    """
+    Reference backend: NumPy array expressions, with the matrix products in the BLAS numpy is
+    linked against.
+    """
+    name = 'numpy'
+
+    def modal_mu(self, w, c, km, taum, freq_win, offset=0.0):
+        """
+        Real part of the modal eigenvalues -4 pi / (k^2 - km^2 - 1j * k / (taum * c) + offset) * freq_win
+        with k = w / c, evaluated in real arithmetic to avoid complex [nMod, nFreq] temporaries.
+
+        Parameters:
+        - w: Angular solution frequencies (size = [nFreq])
+        - c: Speed of sound, a scalar or one value per mode (size = [nMod])
+        - km: Wavenumbers of the modes (size = [nMod])
+        - taum: Decay time constants of the modes (size = [nMod])
+        - freq_win: Source filter window (size = [nFreq])
+        - offset: Constant added to the denominator
+
+        Returns:
+        - mu: Eigenvalues of the modes (size = [nMod, nFreq])
+        """
+        c = np.asarray(c, dtype=float)
+        c = c[:, None] if c.ndim else c
+        k = w / c
+        re = k ** 2 - km[:, None] ** 2 + offset
+        im = k / (taum[:, None] * c)
+        mu = re * freq_win.real
+        mu -= im * freq_win.imag
+        re *= re
+        im *= im
+        re += im
+        mu /= re
+        mu *= -4 * np.pi
+        return mu
+
+    def modal_mu_complex(self, w, c, km, taum, freq_win, offset=0.0):
+        """
+        Complex modal eigenvalues -4 pi / (k^2 - km^2 - 1j * k / (taum * c) + offset) * freq_win,
+        whose real part is modal_mu. Needed where the phase matters, e.g. for impulse responses.
+
+        Returns:
+        - mu: Eigenvalues of the modes (size = [nMod, nFreq])
+        """
+        c = np.asarray(c, dtype=float)
+        c = c[:, None] if c.ndim else c
+        k = w / c
+        return -4 * np.pi / (k ** 2 - km[:, None] ** 2 - 1j * k / (taum[:, None] * c) + offset) * freq_win
+
+    def scatter_weights(self, cells, scale, mu, psi_s, out):
+        """
+        Modal coefficients scale * mu * psi_s of the separable modal sum, written to rows cells
+        of out (size = [nCells, nFreq * sPos]). Every cell occurs at most once.
+        """
+        out[cells] = (scale[:, None, None] * mu[:, :, None] * psi_s[:, None, :]).reshape(len(cells), -1)
+        return out
+
+class NumbaBackend(NumpyBackend):
+    """
+    Multithreaded numba kernels that compute mu and the separable coefficients in one pass
+    over the output, without temporaries. Matrix products stay in BLAS.
+    """
+    name = 'numba'
+
+    def __init__(self):
+        # numba is only imported once this backend is selected
+        import numba_kernels
+        self.kernels = numba_kernels
+        if _num_threads is not None:
+            numba_kernels.set_num_threads(_num_threads)
+
+    def modal_mu(self, w, c, km, taum, freq_win, offset=0.0):
+        c = np.broadcast_to(np.asarray(c, dtype=float), km.shape)
+        mu = np.empty((len(km), len(w)))
+        self.kernels.modal_mu_kernel(np.ascontiguousarray(w, dtype=float), np.ascontiguousarray(c),
+                                     np.ascontiguousarray(km, dtype=float), np.ascontiguousarray(taum, dtype=float),
+                                     np.ascontiguousarray(freq_win.real), np.ascontiguousarray(freq_win.imag),
+                                     float(offset), mu)
+        return mu
+
+    def scatter_weights(self, cells, scale, mu, psi_s, out):
+        if out.dtype != np.float64 or not out.flags.c_contiguous:
+            return super().scatter_weights(cells, scale, mu, psi_s, out)
+        self.kernels.scatter_weights_kernel(np.ascontiguousarray(cells), np.ascontiguousarray(scale, dtype=float),
+                                            np.ascontiguousarray(mu, dtype=float),
+                                            np.ascontiguousarray(psi_s, dtype=float), out)
+        return out
+
+BACKENDS = {'numpy': NumpyBackend}
+if importlib.util.find_spec('numba') is not None:  # The numba backend is optional
+    BACKENDS['numba'] = NumbaBackend
+
+_backend = NumpyBackend()
+_num_threads = None
+
+def get_backend():
+    """
+    Backend used by the solvers and modal sums.
+    """
+    return _backend
+
+def set_backend(name):
+    """
+    Select the backend by name: 'numpy' (default) or 'numba' (requires numba).
+    """
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError(f"Backend '{name}' is not available. Should be one of {available_backends()}.")
+    _backend = BACKENDS[name]()
+    return _backend
+
+def available_backends():
+    return list(BACKENDS)
+
+def set_num_threads(threads):
+    """
+    Set the number of CPU threads of the BLAS runtime and of the numba kernels.
+
+    The BLAS threads are changed in the running process if threadpoolctl is installed. The
+    environment variables are set as well, so worker processes started afterwards use the same
+    count. The numba threads are set when the numba backend is selected, if it is not yet.
+    """
+    global _num_threads
+    _num_threads = threads
+    os.environ.update({name: str(threads) for name in BLAS_THREAD_VARS})
+    if threadpool_limits is not None:
+        threadpool_limits(limits=threads)
+    if 'numba_kernels' in sys.modules:
+        sys.modules['numba_kernels'].set_num_threads(threads)
+
+def check_backends(seed=1, rtol=1e-10):
+    """
+    Check that every available backend reproduces the NumPy reference backend on one room.
+
+    The z = 0 solver with the separable and dense modal sums, the batched solver and the 3-D
+    solver are run with each backend.
+
+    Returns:
+    - errors: Largest relative deviation from the reference per backend
+
+    Raises:
+    - AssertionError: If a backend deviates by more than rtol
+    """
+    from init import create_setup
+    import green_3d_freq_modal_response as solver
+    from modal_sum import modal_sum, separable_modal_sum, batched_separable_modal_sum
+
+    setups = [create_setup(seed=seed + offset, num_sources=2) for offset in range(3)]
+
+    def run():
+        grid, mu, psi_s = solver.green_3d_freq_modal_response_z0(400, setups[0], method='separable')
+        psi_r = solver.green_3d_freq_modal_response_z0(400, setups[0])[0]
+        return [separable_modal_sum(grid, mu, psi_s), modal_sum(psi_r, mu, psi_s),
+                batched_separable_modal_sum(*solver.green_3d_freq_modal_response_z0_batch(400, setups)),
+                solver.green_3d_freq_modal_response(200, setups[0])[1]]
+
+    previous = get_backend().name
+    try:
+        set_backend('numpy')
+        reference = run()
+        errors = {}
+        for name in available_backends():
+            set_backend(name)
+            errors[name] = max(float(np.abs(result - expected).max() / np.abs(expected).max())
+                               for result, expected in zip(run(), reference))
+    finally:
+        set_backend(previous)
+
+    failed = {name: error for name, error in errors.items() if error > rtol}
+    if failed:
+        raise AssertionError(f'Backends deviate from the numpy reference by more than {rtol}: {failed}')
+    return errors
+
+
+if __name__ == "__main__":
+    # Run the check in the imported module, whose backend the solvers use
+    import backend
+    for name, error in backend.check_backends().items():
+        print(f"{name}: max relative deviation {error:.2e}")
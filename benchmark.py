@@ -0,0 +1,237 @@
+"""
+Benchmarks of the dataset generation stages.
+
+Every stage is timed and memory-profiled separately over a sweep of parameters, and the
+results are written as JSON so runs on different commits can be compared:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --quick
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import green_3d_freq_modal_response as solver
+from init import create_setup
+from SampleGrid import SampleGrid
+from modal_sum import modal_sum, separable_modal_sum, batched_separable_modal_sum
+from dataset_store import DatasetWriter
+from impulse_response import room_impulse_responses
+import backend
+from create_dataset import create_dataset
+
+def measure(function, repeat=3):
+    """
+    Time a function and record the peak memory it allocates.
+
+    Returns:
+    - result: Dictionary with the best and median wall time [s] over the repetitions and the
+      peak traced allocation [bytes] of the first call
+    """
+    times = []
+    peak = 0
+    for i in range(repeat):
+        if i == 0:
+            tracemalloc.start()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+        if i == 0:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return {'time_min': min(times), 'time_median': float(np.median(times)), 'peak_bytes': peak}
+
+def make_setup(seed, grid, fs, duration):
+    Setup = create_setup(seed=seed, equidistant=(grid == 'equidistant'))
+    Setup['Fs'] = fs
+    Setup['Duration'] = duration
+    return Setup
+
+def bench_setup(grid, repeat):
+    equidistant = grid == 'equidistant'
+    Setup = create_setup(seed=1, equidistant=equidistant)
+    return [
+        {'stage': 'create_setup', 'grid': grid,
+         **measure(lambda: create_setup(seed=1, equidistant=equidistant), repeat)},
+        {'stage': 'SampleGrid', 'grid': grid, 'receivers': len(Setup['Observation']['Point']),
+         **measure(lambda: SampleGrid(Setup), repeat)},
+    ]
+
+def bench_room(freq_lim, grid, fs, duration, repeat):
+    """
+    Solver, modal sum and save stages of one room.
+    """
+    Setup = make_setup(1, grid, fs, duration)
+    params = {'freq_lim': freq_lim, 'grid': grid, 'Fs': fs, 'Duration': duration,
+              'receivers': len(Setup['Observation']['Point'])}
+    results = []
+
+    def solve(method):
+        # Start cold, as every new room geometry misses the mode enumeration cache
+        solver.clear_caches()
+        return solver.green_3d_freq_modal_response_z0(freq_lim, Setup, method=method)
+
+    psi_r, mu, psi_s = solve('vectorized')
+    grid_factors = solve('separable')[0]
+    params['modes'] = len(mu)
+    for method in ('loop', 'vectorized', 'separable'):
+        results.append({'stage': 'solver_z0', 'method': method, **params,
+                        **measure(lambda: solve(method), repeat)})
+
+    frequency_response = modal_sum(psi_r, mu, psi_s)
+    params['tensor_bytes'] = frequency_response.nbytes
+    results.append({'stage': 'modal_sum', 'method': 'dense', **params,
+                    **measure(lambda: modal_sum(psi_r, mu, psi_s), repeat)})
+    results.append({'stage': 'modal_sum', 'method': 'separable', **params,
+                    **measure(lambda: separable_modal_sum(grid_factors, mu, psi_s), repeat)})
+
+    results.append({'stage': 'rir', **params,
+                    **measure(lambda: room_impulse_responses(Setup, freq_lim), repeat)})
+
+    with tempfile.TemporaryDirectory() as root, DatasetWriter(root) as writer:
+        rooms = iter(range(repeat))
+        results.append({'stage': 'save', **params,
+                        **measure(lambda: writer.append(f'Room{next(rooms)}', frequency_response, Setup=Setup), repeat)})
+    return results
+
+def bench_solver_3d(freq_lim, repeat):
+    Setup = create_setup(seed=1)
+    results = []
+    for method in ('loop', 'vectorized'):
+        def solve():
+            solver.clear_caches()
+            return solver.green_3d_freq_modal_response(freq_lim, Setup, method=method)
+        results.append({'stage': 'solver_3d', 'method': method, 'freq_lim': freq_lim,
+                        'modes': len(solve()[1]), **measure(solve, repeat)})
+    return results
+
+def bench_sources(num_sources, freq_lim, repeat):
+    """
+    All sources of a room in one solve and modal sum, against one solve per source.
+    """
+    Setup = create_setup(seed=1, num_sources=num_sources)
+    singles = [dict(Setup, Source=dict(Setup['Source'], Position=[position])) for position in Setup['Source']['Position']]
+
+    def solve(setup):
+        grid, mu, psi_s = solver.green_3d_freq_modal_response_z0(freq_lim, setup, method='separable')
+        return separable_modal_sum(grid, mu, psi_s)
+
+    params = {'stage': 'sources', 'sources': num_sources, 'freq_lim': freq_lim}
+    return [{**params, 'method': 'batched', **measure(lambda: solve(Setup), repeat)},
+            {**params, 'method': 'per_source', **measure(lambda: [solve(single) for single in singles], repeat)}]
+
+def bench_batch(batch_size, freq_lim, band, margin, repeat):
+    """
+    Solver and modal sum of batch_size rooms with the batched solver, against one room at a time.
+    """
+    setups = [create_setup(seed=seed) for seed in range(1, batch_size + 1)]
+    bins = solver.frequency_bins(setups[0], band=band)
+
+    def single():
+        for Setup in setups:
+            separable_modal_sum(*solver.green_3d_freq_modal_response_z0(freq_lim, Setup, method='separable', bins=bins, margin=margin))
+
+    def batched():
+        batched_separable_modal_sum(*solver.green_3d_freq_modal_response_z0_batch(freq_lim, setups, bins=bins, margin=margin))
+
+    params = {'stage': 'batch', 'rooms': batch_size, 'freq_lim': freq_lim, 'band': band, 'margin': margin}
+    return [{**params, 'method': 'per_room', **measure(single, repeat)},
+            {**params, 'method': 'batched', **measure(batched, repeat)}]
+
+def bench_backends(freq_lim, repeat):
+    """
+    Separable solve and modal sum of one room with every available backend.
+    """
+    Setup = create_setup(seed=1)
+    previous = backend.get_backend().name
+    results = []
+    try:
+        for name in backend.available_backends():
+            backend.set_backend(name)
+            solve = lambda: separable_modal_sum(*solver.green_3d_freq_modal_response_z0(freq_lim, Setup, method='separable'))
+            solve()  # Compile the JIT kernels outside the measurement
+            results.append({'stage': 'backend', 'method': name, 'freq_lim': freq_lim, **measure(solve, repeat)})
+    finally:
+        backend.set_backend(previous)
+    return results
+
+def bench_dataset(num_rooms, workers):
+    """
+    End-to-end create_dataset, including writing the store.
+    """
+    with tempfile.TemporaryDirectory() as root, contextlib.redirect_stdout(io.StringIO()):
+        result = measure(lambda: create_dataset(num_rooms, output=root, workers=workers), repeat=1)
+    return {'stage': 'create_dataset', 'rooms': num_rooms, 'workers': workers,
+            'rooms_per_second': num_rooms / result['time_min'], **result}
+
+def bench_startup(repeat):
+    """
+    Cold start of create_dataset in fresh interpreters: the import a spawned worker pays, the
+    command line entry point, and a one-room command line run.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(here, 'create_dataset.py')
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        commands = {'import': [sys.executable, '-c', 'import create_dataset'],
+                    'cli_help': [sys.executable, script, '--help'],
+                    'cli_room': [sys.executable, script, '--rooms', '1', '--output', root]}
+        for name, command in commands.items():
+            result = measure(lambda: subprocess.run(command, cwd=here, capture_output=True, check=True), repeat)
+            results.append({'stage': 'startup', 'command': name, **result})
+    return results
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count(), 'time': time.time()}
+
+def run(quick=False, repeat=3, workers=1):
+    if quick:
+        freq_lims, grids, rates, room_counts, source_counts = [200, 400], ['fixed'], [(1200, 1)], [2], [16]
+    else:
+        freq_lims, grids, rates, room_counts, source_counts = [200, 400, 800], ['fixed', 'equidistant'], [(1200, 1), (2400, 2)], [5, 20], [16, 64]
+
+    results = bench_startup(repeat)
+    for grid in grids:
+        results += bench_setup(grid, repeat)
+        for freq_lim in freq_lims:
+            for fs, duration in rates:
+                results += bench_room(freq_lim, grid, fs, duration, repeat)
+    results += bench_solver_3d(min(freq_lims), repeat)
+    for num_sources in source_counts:
+        results += bench_sources(num_sources, max(freq_lims), repeat)
+    results += bench_backends(max(freq_lims), repeat)
+    for band, margin in ((None, None), ((50, 150), 20)):
+        results += bench_batch(16, max(freq_lims), band, margin, repeat)
+    for num_rooms in room_counts:
+        results.append(bench_dataset(num_rooms, workers))
+    return {'environment': environment(), 'results': results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--output', help='JSON file to write (default: stdout)')
+    parser.add_argument('--quick', action='store_true', help='small sweep for a fast check')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions per measurement')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes for create_dataset')
+    args = parser.parse_args()
+
+    report = run(quick=args.quick, repeat=args.repeat, workers=args.workers)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
@@ -1,66 +1,419 @@
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
 import numpy as np
-import scipy.io
-import matplotlib.pyplot as plt
-from scipy.signal import butter, filtfilt
 from init import create_setup
-from green_3d_freq_modal_response import green_3d_freq_modal_response, green_3d_freq_modal_response_z0
-from draw_setup import draw_setup
-import pickle
+from green_3d_freq_modal_response import green_3d_freq_modal_response_z0, green_3d_freq_modal_response_z0_batch, unbatch_factors, enumerate_modes, frequency_bins
+from modal_sum import modal_sum, separable_modal_sum, batched_separable_modal_sum
+from dataset_store import DatasetWriter, compact_setup, params_hash
+from graph_edges import GRID_OFFSETS, grid_edges
+from adaptive_grid import adaptive_grid
+from impulse_response import room_impulse_responses
+from room_response import RoomResponse
+from telemetry import Telemetry
+from backend import BLAS_THREAD_VARS, set_backend, set_num_threads
 
-def create_dataset(num_rooms,plot=0,save=True):
+def create_dataset(num_rooms,plot=0,save=True,output='dataset',workers=1,ordered=True,connectivity=4,separable=True,
+                   telemetry=None,storage='native',band=None,margin=None,freq_lim=400,num_sources=1,batch_size=1,
+                   resume=False,first_seed=1,shard=None,rir=False,rir_length=None,backend='numpy',threads=None,
+                   adaptive=None,equidistant=False):
+    """
+    Generate the rooms with seeds first_seed, ..., first_seed + num_rooms - 1 and stream them to
+    the dataset store.
 
-    savedata = {}
+    Every room is recorded with its seed and a hash of the generation parameters. With
+    resume=True an existing store in output is appended to: rooms already stored with the same
+    parameters are skipped, and rooms whose files are incomplete are generated again. The
+    same call restarts an interrupted run or extends a dataset to more rooms.
 
-    for j in range(1, num_rooms + 1):
-        print(f"Room {j}")
-        Setup = create_setup(seed=j, equidistant=0)
+    Parameters:
+    - num_rooms: Number of rooms to generate
+    - plot: Draw each room and its transfer functions at a few frequencies
+    - save: Write the rooms to the dataset store
+    - output: Directory of the dataset store
+    - workers: Number of worker processes. Rooms are generated in-process if 1
+    - ordered: Collect the rooms in seed order. Otherwise rooms are written as they finish
+    - connectivity: Neighbours of each receiver in the stored grid graph, 4 or 8
+    - separable: Use the separable grid solver, which never builds the receiver eigenfunctions
+    - telemetry: Optional Telemetry receiving per-stage and per-room events
+    - storage: Storage format of the frequency responses: 'native', 'complex64', 'magphase16'
+      or 'db16' (see storage_codecs.encode_response), or 'factorized' to store the mode table,
+      mu and psi_s of every room instead of the dense tensor (requires separable)
+    - band: Optional band limits [f_min, f_max] in Hz. Only the bins in the band are computed and stored
+    - margin: If given, only modes resonating within margin [Hz] of the band are included
+    - freq_lim: Highest eigenfunction resonance frequency included in the calculations
+    - num_sources: Number of source positions per room. All sources of a room share its modes
+      and are solved together; rooms are stored as [rPos, nFreq] for a single source and as
+      [rPos, nFreq, sPos] otherwise
+    - batch_size: Number of rooms solved together by the batched solver (requires separable).
+      Pays off for band-limited runs, where the per-room arrays are small
+    - resume: Continue the dataset in output instead of starting a new one
+    - first_seed: Seed of the first room
+    - shard: Optional (index, count) to generate only the index-th of count contiguous, disjoint
+      slices of the seeds, e.g. on separate machines. The shards are combined with
+      dataset_store.merge_datasets
+    - rir: Also store the room impulse responses at all receivers, sampled at Fs
+    - rir_length: Optional number of samples the impulse responses are truncated to
+    - backend: Array backend of the solver and modal sums, 'numpy' or 'numba' (see backend.py)
+    - threads: CPU threads per process for BLAS and the backend kernels. By default all cores
+      are used, shared equally between the worker processes
+    - adaptive: If given, the receivers of each room are refined adaptively with this tolerance
+      instead of placed on the SampleGrid grid (see adaptive_grid.adaptive_grid). Every room
+      then has its own receivers, stored in its Setup, and its own edges. Requires the dense
+      storage formats and batch_size 1
+    - equidistant: Place the receivers on the equidistant 0.1 m grid of create_setup instead of
+      the 32 x 32 grid. The grid shape then differs between rooms, so batch_size must be 1
+    """
+    # Check the arguments before the writer opens (and, unless resuming, truncates) the index
+    if adaptive is not None and (storage == 'factorized' or batch_size > 1):
+        raise ValueError('Adaptive receivers cannot be stored factorized or solved in batches.')
+    if not separable and (storage == 'factorized' or batch_size > 1):
+        raise ValueError('Factorized storage and batched generation require the separable solver.')
+    if batch_size < 1:
+        raise ValueError(f'Invalid batch_size {batch_size}. Should be at least 1.')
+    if connectivity not in GRID_OFFSETS:
+        raise ValueError(f'Invalid connectivity {connectivity}. Should be one of {list(GRID_OFFSETS)}.')
+    # The solution frequencies are the same for all rooms; this checks the band against Fs / 2
+    frequency_bins(create_setup(seed=first_seed), band=band)
+    seeds = range(first_seed, first_seed + num_rooms)
+    if shard is not None:
+        seeds = shard_seeds(seeds, *shard)
+    if telemetry is None:
+        telemetry = Telemetry()
+    set_backend(backend)
+    if threads is not None and workers == 1:
+        set_num_threads(threads)
 
-        # Generate observed data
-        freq_lim = 400
-        psi_r, mu, psi_s = green_3d_freq_modal_response_z0(freq_lim,Setup)
+    # Each room is streamed to disk as soon as it is computed
+    writer = DatasetWriter(output, mode='a' if resume else 'w', storage=storage) if save else None
 
-        frequency_response = np.zeros((len(psi_r), len(mu[0]), len(psi_s[0])))
-        for i in range(len(mu[0])):
-            frequency_response[:, i, :] = np.dot(psi_r, np.diag(mu[:, i])) @ psi_s
+    # Parameters that change the stored rooms; a resumed dataset must have been generated with the same
+    params = {'freq_lim': freq_lim, 'band': band, 'margin': margin, 'num_sources': num_sources,
+              'storage': storage, 'connectivity': connectivity, 'rir': rir, 'rir_length': rir_length}
+    if adaptive is not None:
+        params['adaptive'] = adaptive
+    if equidistant:
+        params['equidistant'] = equidistant
+    params_key = params_hash(params)
+    if save and resume:
+        mismatched = {entry.get('params_hash') for entry in writer.entries} - {params_key}
+        if mismatched:
+            writer.close()
+            raise ValueError(f"The dataset in '{output}' was generated with different parameters than {params}.")
+        done = {entry['seed'] for entry in writer.entries}
+        seeds = [j for j in seeds if j not in done]
+        print(f"Resuming: {len(done)} rooms done, {len(seeds)} to generate")
+    if telemetry.total is None:
+        telemetry.total = len(seeds)
+    room_args = {'freq_lim': freq_lim, 'separable': separable, 'band': band, 'margin': margin,
+                 'lazy': storage == 'factorized', 'num_sources': num_sources, 'adaptive': adaptive,
+                 'equidistant': equidistant}
+    if workers > 1:
+        rooms = _generate_rooms_parallel(seeds, workers, ordered, room_args, telemetry, batch_size, backend, threads)
+    else:
+        rooms = _generate_rooms(seeds, room_args, telemetry, batch_size)
 
-        # Reshape to 3D arrays
-        x_coor = np.arange(0, Setup['Room']['Dim'][0] + Setup['Observation']['xSamplingDistance'], Setup['Observation']['xSamplingDistance'])
-        y_coor = np.arange(0, Setup['Room']['Dim'][1] + Setup['Observation']['ySamplingDistance'], Setup['Observation']['ySamplingDistance'])
+    for j, Setup, frequency_response in rooms:
+        print(f"Room {j}")
+        room_edges = Setup['Observation'].pop('Edges', None)
         frequency = np.arange(0, Setup['Fs']/2, 1/Setup['Duration'])
+        bins = frequency_bins(Setup, band=band)
+        if bins is not None:
+            frequency = frequency[bins]
+        if isinstance(frequency_response, RoomResponse):
+            response = frequency_response
+            frequency_response = response.dense().reshape(Setup['Observation']['ySamples'], Setup['Observation']['xSamples'], *response.shape[1:]) if plot else None
+        else:
+            response = frequency_response.reshape(-1, *frequency_response.shape[-2:])
+            if num_sources == 1:
+                response = response[:, :, 0]
 
-        frequency_response = frequency_response.squeeze()
-        # frequency_responseの1次元目の引数について... (2次元目は周波数領域)
-        # 0,1,...,len(x_coor)-1 は隣接
-        # 0,1*len(x_coor),2*len(x_coor),...,(len(y_coor)-1)*len(x_coor) は隣接
-
-        frequency_response = frequency_response.reshape(len(y_coor), len(x_coor), len(frequency))
-        abs_frequency_response = np.abs(frequency_response)
+        impulse_response = None
+        if rir:
+            telemetry.room = j
+            with telemetry.stage('rir') as record:
+                # From the complex mu; the stored responses are real and carry no phase
+                impulse_response = room_impulse_responses(Setup, freq_lim, bins=bins, margin=margin, length=rir_length)
+                if num_sources == 1:
+                    impulse_response = impulse_response[:, :, 0]
+                record['tensor_bytes'] = impulse_response.nbytes
 
-        savedata[f'Room{j+1}'] = {'FrequencyResponse': frequency_response.reshape(-1,len(frequency)),
-                                  'edges': {},
-                                  'Setup': Setup}
+        if save:
+            telemetry.room = j
+            with telemetry.stage('save'):
+                # Grid edges are stored once per grid shape and shared by the rooms, those of
+                # adaptive receivers per room
+                x_samples, y_samples = Setup['Observation']['xSamples'], Setup['Observation']['ySamples']
+                if room_edges is not None:
+                    edges = writer.add_edges(f'Room{j+1}', room_edges, shared=False)
+                else:
+                    edges = writer.add_edges(f'grid_{y_samples}x{x_samples}_{connectivity}',
+                                             grid_edges(x_samples, y_samples, connectivity))
+                writer.append(f'Room{j+1}', response,
+                              impulse_response=impulse_response,
+                              seed=j,
+                              params_hash=params_key,
+                              edges=edges,
+                              freq_lim=freq_lim,
+                              margin=margin,
+                              bins=bins,
+                              Setup=compact_setup(Setup))
+        telemetry.room_done(j)
 
         if plot:
+            # Plotting is imported on first use, so headless runs never load matplotlib
+            import matplotlib.pyplot as plt
+            from draw_setup import draw_setup
+
             # Draw the simulated setup
             draw_setup(Setup)
 
             # Plot the Transfer function at a given frequency
-            freq_idces = [100,300,500]
+            freq_idces = [freq_idx for freq_idx in [100,300,500] if freq_idx < len(frequency)]
 
             for freq_idx in freq_idces:
                 plt.figure()
                 #plt.contourf(y_coor, x_coor, abs_frequency_response[:, :, freq_idx].T, edgecolor='none')
-                plt.imshow(frequency_response[:,:,freq_idx])
+                if room_edges is not None:
+                    points = Setup['Observation']['Point']
+                    plt.scatter(points[:, 0], points[:, 1], c=frequency_response[:, freq_idx, 0], s=4)
+                else:
+                    plt.imshow(frequency_response[:,:,freq_idx,0])
                 plt.xlabel('X-dimension [m]')
                 plt.ylabel('Y-dimension [m]')
                 plt.title(f'Contour plot of TF magnitude throughout the room at f = {frequency[freq_idx]:.1f} Hz')
                 plt.colorbar()
                 plt.show()
-        
-        if save:
-            with open('tensors.pkl', 'wb') as f:
-                pickle.dump(savedata, f)
+
+    if save:
+        writer.close()
+
+def shard_seeds(seeds, index, count):
+    """
+    Contiguous slice index (0, ..., count - 1) of count near-equal, disjoint slices of seeds.
+    """
+    if not 0 <= index < count:
+        raise ValueError(f'Shard index {index} must lie between 0 and {count - 1}.')
+    return seeds[len(seeds) * index // count:len(seeds) * (index + 1) // count]
+
+def generate_room(j, freq_lim=400, separable=True, telemetry=None, band=None, margin=None, lazy=False, num_sources=1,
+                  adaptive=None, equidistant=False):
+    """
+    Create the setup of the room with seed j and compute its frequency responses.
+
+    With separable=True the modal sum is computed from the per-axis factors of the receiver
+    eigenfunctions on the grid instead of the dense [rPos, nMod] matrix. With band, only the
+    frequency bins in [f_min, f_max] are computed, including the modes resonating within margin
+    of the band (all modes if margin is None). With lazy=True the modal sum is skipped and the
+    room is returned as a RoomResponse (requires separable). The num_sources sources share the
+    mode table, receiver factors and mu, and are assembled in the same modal sum. With adaptive,
+    the receivers are refined with this tolerance by adaptive_grid and solved with the dense
+    solver; their edges are returned in Setup['Observation']['Edges']. The stages are timed with
+    telemetry, if given. With equidistant, the receivers are on the equidistant grid of
+    create_setup.
+
+    Returns:
+    - j: Seed of the room
+    - Setup: Dictionary containing the configuration and parameters
+    - frequency_response: Transfer functions on the observation grid (size = [ySamples, xSamples, nFreq, sPos]),
+      at the adaptive receivers (size = [rPos, nFreq, sPos]), or the RoomResponse of the room if lazy
+    """
+    if telemetry is None:
+        telemetry = Telemetry()
+    telemetry.room = j
+
+    with telemetry.stage('setup'):
+        Setup = create_setup(seed=j, equidistant=equidistant, num_sources=num_sources)
+
+    # Enumerate the modes up front to time them separately; the solver reuses the cached table
+    with telemetry.stage('mode_enumeration') as record:
+        record['modes'] = len(enumerate_modes(freq_lim, Setup['Room']['Dim'][:2], Setup['Ambient']['c']))
+
+    # Generate observed data
+    bins = frequency_bins(Setup, band=band)
+    if adaptive is not None:
+        if lazy:
+            raise ValueError('Lazy room responses require the SampleGrid grid.')
+        with telemetry.stage('adaptive_grid') as record:
+            Setup, edges = adaptive_grid(Setup, freq_lim, tolerance=adaptive, bins=bins, margin=margin)
+            Setup['Observation']['Edges'] = edges
+            record['receivers'] = len(Setup['Observation']['Point'])
+    if separable and adaptive is None:
+        with telemetry.stage('solver', method='separable'):
+            grid, mu, psi_s = green_3d_freq_modal_response_z0(freq_lim, Setup, method='separable', bins=bins, margin=margin)
+        if lazy:
+            return j, Setup, RoomResponse(Setup, grid, mu, psi_s, bins=bins)
+        with telemetry.stage('modal_sum', method='separable') as record:
+            frequency_response = separable_modal_sum(grid, mu, psi_s)
+            record['tensor_bytes'] = frequency_response.nbytes
+    elif lazy:
+        raise ValueError('Lazy room responses require the separable solver.')
+    else:
+        with telemetry.stage('solver', method='vectorized'):
+            psi_r, mu, psi_s = green_3d_freq_modal_response_z0(freq_lim, Setup, bins=bins, margin=margin)
+        with telemetry.stage('modal_sum', method='dense') as record:
+            frequency_response = modal_sum(psi_r, mu, psi_s)
+            record['tensor_bytes'] = frequency_response.nbytes
+
+    if adaptive is not None:
+        return j, Setup, frequency_response
+
+    # Reshape to 4D arrays
+    # frequency_responseの1次元目の引数について... (2次元目は周波数領域)
+    # 0,1,...,xSamples-1 は隣接
+    # 0,1*xSamples,2*xSamples,...,(ySamples-1)*xSamples は隣接
+
+    frequency_response = frequency_response.reshape(Setup['Observation']['ySamples'], Setup['Observation']['xSamples'],
+                                                    *frequency_response.shape[1:])
+    return j, Setup, frequency_response
+
+def generate_room_batch(seeds, freq_lim=400, separable=True, telemetry=None, band=None, margin=None, lazy=False, num_sources=1,
+                        adaptive=None, equidistant=False):
+    """
+    Create the setups of the rooms with the given seeds and compute their frequency responses
+    together with the batched solver. The results are those of generate_room for each seed.
+
+    Returns:
+    - rooms: List of (j, Setup, frequency_response) tuples as returned by generate_room
+    """
+    if not separable:
+        raise ValueError('Batched room generation requires the separable solver.')
+    if adaptive is not None:
+        raise ValueError('Batched room generation requires the SampleGrid grid.')
+    if telemetry is None:
+        telemetry = Telemetry()
+    seeds = list(seeds)
+    telemetry.room = seeds
+
+    with telemetry.stage('setup', rooms=len(seeds)):
+        setups = [create_setup(seed=j, equidistant=equidistant, num_sources=num_sources) for j in seeds]
+
+    with telemetry.stage('mode_enumeration', rooms=len(seeds)) as record:
+        record['modes'] = sum(len(enumerate_modes(freq_lim, Setup['Room']['Dim'][:2], Setup['Ambient']['c'])) for Setup in setups)
+
+    bins = frequency_bins(setups[0], band=band)
+    with telemetry.stage('solver', method='batched', rooms=len(seeds)):
+        grid, mu, psi_s = green_3d_freq_modal_response_z0_batch(freq_lim, setups, bins=bins, margin=margin)
+    if lazy:
+        return [(j, Setup, RoomResponse(Setup, *unbatch_factors(grid, mu, psi_s, index), bins=bins))
+                for index, (j, Setup) in enumerate(zip(seeds, setups))]
+
+    with telemetry.stage('modal_sum', method='batched', rooms=len(seeds)) as record:
+        frequency_response = batched_separable_modal_sum(grid, mu, psi_s)
+        record['tensor_bytes'] = frequency_response.nbytes
+
+    shape = (setups[0]['Observation']['ySamples'], setups[0]['Observation']['xSamples'], *frequency_response.shape[2:])
+    return [(j, Setup, room.reshape(shape)) for j, Setup, room in zip(seeds, setups, frequency_response)]
+
+def _generate_rooms(seeds, room_args, telemetry, batch_size=1):
+    """
+    Generate rooms one by one, or batch_size at a time with the batched solver.
+    """
+    if batch_size == 1:
+        for j in seeds:
+            yield generate_room(j, telemetry=telemetry, **room_args)
+        return
+    seeds = iter(seeds)
+    for batch in iter(lambda: list(itertools.islice(seeds, batch_size)), []):
+        yield from generate_room_batch(batch, telemetry=telemetry, **room_args)
+
+def _generate_rooms_parallel(seeds, workers, ordered, room_args, telemetry, batch_size=1, backend='numpy', threads=None):
+    """
+    Generate rooms in a pool of worker processes.
+
+    Every room only depends on its seed, so the results are identical to the serial loop. At
+    most 2 * workers batches of batch_size rooms are in flight to keep the memory of the parent
+    bounded, and each worker gets threads CPU threads (default: an equal share of the cores) and
+    the given backend. The stage events recorded in the workers are passed on to telemetry.
+    """
+    seeds = iter(seeds)
+    batches = iter(lambda: list(itertools.islice(seeds, batch_size)), [])
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+    context = multiprocessing.get_context('spawn')
+    with _blas_threads(threads), ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                                     initargs=(backend, threads)) as executor:
+        pending = [executor.submit(_generate_rooms_traced, batch, room_args, batch_size) for batch in itertools.islice(batches, 2 * workers)]
+        while pending:
+            if ordered:
+                future = pending[0]
+            else:
+                future = next(iter(wait(pending, return_when=FIRST_COMPLETED).done))
+            pending.remove(future)
+            pending.extend(executor.submit(_generate_rooms_traced, batch, room_args, batch_size) for batch in itertools.islice(batches, 1))
+            rooms, events = future.result()
+            for event in events:
+                telemetry.emit(event)
+            yield from rooms
+
+def _init_worker(backend, threads):
+    set_backend(backend)
+    set_num_threads(threads)
+
+def _generate_rooms_traced(seeds, room_args, batch_size):
+    telemetry = Telemetry(keep_events=True)
+    return list(_generate_rooms(seeds, room_args, telemetry, batch_size)), telemetry.events
+
+@contextmanager
+def _blas_threads(threads):
+    """
+    Set the BLAS/OpenMP thread count inherited by the worker processes spawned in this context.
+    """
+    saved = {name: os.environ.get(name) for name in BLAS_THREAD_VARS}
+    os.environ.update({name: str(threads) for name in BLAS_THREAD_VARS})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def main(argv=None):
+    """
+    Command line entry point, e.g. for one shard of a dataset generated by many short jobs:
+
+        python create_dataset.py --rooms 10000 --shard 3/100 --output shard3
+
+    Only numpy and the solver modules are loaded at startup; matplotlib is never imported.
+    """
+    import argparse
+
+    def shard_arg(value):
+        try:
+            index, count = (int(part) for part in value.split('/'))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid shard '{value}', expected i/N")
+        if not 0 <= index < count:
+            raise argparse.ArgumentTypeError(f'shard index {index} must lie between 0 and {count - 1}')
+        return index, count
+
+    parser = argparse.ArgumentParser(description='Generate a dataset of simulated room transfer functions.')
+    parser.add_argument('--rooms', type=int, default=100, help='number of rooms (seeds) in the whole dataset')
+    parser.add_argument('--first-seed', type=int, default=1, help='seed of the first room')
+    parser.add_argument('--shard', type=shard_arg, help='generate only slice i of N of the seeds, given as i/N with i = 0, ..., N - 1')
+    parser.add_argument('--freq-lim', type=int, default=400, help='highest resonance frequency of the modes [Hz]')
+    parser.add_argument('--grid', choices=['fixed', 'equidistant', 'adaptive'], default='fixed',
+                        help='receivers on the 32 x 32 grid, the 0.1 m grid or adaptively refined')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='refinement tolerance of the adaptive grid')
+    parser.add_argument('--band', type=float, nargs=2, metavar=('F_MIN', 'F_MAX'),
+                        help='compute and store only the frequencies in this band [Hz]')
+    parser.add_argument('--output', default='dataset', help='directory of the dataset store')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes')
+    parser.add_argument('--threads', type=int, help='CPU threads per process')
+    parser.add_argument('--backend', default='numpy', help='array backend, numpy or numba')
+    parser.add_argument('--resume', action='store_true', help='skip the rooms already stored in output')
+    args = parser.parse_args(argv)
+
+    create_dataset(args.rooms, plot=0, output=args.output, workers=args.workers, resume=args.resume,
+                   first_seed=args.first_seed, shard=args.shard, freq_lim=args.freq_lim, band=args.band,
+                   equidistant=args.grid == 'equidistant', adaptive=args.tolerance if args.grid == 'adaptive' else None,
+                   backend=args.backend, threads=args.threads)
 
 
 if __name__ == "__main__":
-    create_dataset(100,plot=0)
+    main()
@@ -0,0 +1,405 @@
+import hashlib
+import json
+import os
+import shutil
+import zipfile
+from contextlib import contextmanager
+import numpy as np
+from storage_codecs import STORAGE_FORMATS, decode_response, encode_response
+
+INDEX_FILE = 'index.jsonl'
+ROOM_DIR = 'rooms'
+RIR_DIR = 'rirs'
+EDGE_DIR = 'edges'
+
+class DatasetWriter:
+    """
+    Append-only on-disk store for the generated rooms.
+
+    Every room is written to its own .npy shard under `<root>/rooms` as soon as it is computed,
+    and its metadata is appended as one JSON line to `<root>/index.jsonl`. Shards are written to
+    a temporary file and renamed into place, and the index is flushed after every room, so a
+    crash loses at most the room in flight.
+
+    Parameters:
+    - root: Directory of the dataset
+    - mode: 'w' starts a new dataset, removing the shards and edges left in root by an earlier
+      one, 'a' appends to an existing one after checking it with repair_index. The entries kept
+      are available as `entries`
+    - storage: Storage format of the frequency responses (see storage_codecs.encode_response),
+      or 'factorized' to store the modal factors of a RoomResponse instead of the dense tensor
+    """
+
+    def __init__(self, root, mode='w', storage='native'):
+        if mode not in ('w', 'a'):
+            raise ValueError(f"Unknown mode '{mode}'. Should be 'w' or 'a'.")
+        if storage not in STORAGE_FORMATS + ('factorized',):
+            raise ValueError(f"Unknown storage format '{storage}'. Should be one of {STORAGE_FORMATS + ('factorized',)}.")
+        self.root = root
+        self.storage = storage
+        if mode == 'w':
+            for directory in (ROOM_DIR, RIR_DIR, EDGE_DIR):
+                shutil.rmtree(os.path.join(root, directory), ignore_errors=True)
+        os.makedirs(os.path.join(root, ROOM_DIR), exist_ok=True)
+        self.entries = repair_index(root) if mode == 'a' else []
+        self._index = open(os.path.join(root, INDEX_FILE), mode)
+        self._edge_paths = set()
+
+    def append(self, name, frequency_response, impulse_response=None, **metadata):
+        """
+        Write one room to the store.
+
+        Parameters:
+        - name: Unique name of the room, used as the shard file name
+        - frequency_response: Array with the frequency responses of the room, or its
+          RoomResponse for the 'factorized' storage
+        - impulse_response: Optional impulse responses of the room, stored as is under
+          `<root>/rirs` (see impulse_response.impulse_responses)
+        - metadata: JSON-serializable fields stored in the index entry (e.g. seed, Setup)
+
+        Returns:
+        - entry: The index entry written for the room
+        """
+        if self.storage == 'factorized':
+            path, shape, dtype = self._append_factors(name, frequency_response)
+            storage = {'format': 'factorized'}
+        else:
+            frequency_response = np.asarray(frequency_response)
+            data, storage = encode_response(frequency_response, self.storage)
+            path = os.path.join(ROOM_DIR, f'{name}.npy')
+            _atomic_save(os.path.join(self.root, path), data)
+            shape, dtype = frequency_response.shape, frequency_response.dtype
+
+        entry = {'name': name,
+                 'path': path,
+                 'shape': list(shape),
+                 'dtype': dtype.str,
+                 'storage': storage,
+                 **metadata}
+        if impulse_response is not None:
+            entry['rir'] = os.path.join(RIR_DIR, f'{name}.npy')
+            os.makedirs(os.path.join(self.root, RIR_DIR), exist_ok=True)
+            _atomic_save(os.path.join(self.root, entry['rir']), impulse_response)
+        self._index.write(json.dumps(entry, default=_to_json) + '\n')
+        self._index.flush()
+        os.fsync(self._index.fileno())
+        return entry
+
+    def _append_factors(self, name, response):
+        """
+        Write the mode table, mu and psi_s of a RoomResponse. The receiver factors are rebuilt
+        from the room dimensions and grid parameters of the Setup on load.
+        """
+        grid = response.grid
+        path = os.path.join(ROOM_DIR, f'{name}.npz')
+        with _atomic_open(os.path.join(self.root, path)) as f:
+            np.savez(f, modal_numbers=grid['modal_numbers'].astype(np.int16), scale=grid['scale'],
+                     mu=response.mu, psi_s=response.psi_s)
+
+        # A single source is stored as [rPos, nFreq], like the dense tensors
+        shape = response.shape if response.shape[2] > 1 else response.shape[:2]
+        return path, shape, np.result_type(grid['cos_x'], response.mu, response.psi_s)
+
+    def add_edges(self, key, edges, shared=True):
+        """
+        Write a graph edge list shared by all rooms with the same receiver layout.
+
+        The edges are stored once under `<root>/edges/<key>.npy`; rooms refer to them by the
+        returned path, e.g. writer.append(name, frequency_response, edges=path). The key must
+        identify the layout, like the grid shape and connectivity. Edges of a single room
+        (shared=False) are written every time, so they never refer to an earlier room.
+        """
+        path = os.path.join(EDGE_DIR, f'{key}.npy')
+        if not shared:
+            os.makedirs(os.path.join(self.root, EDGE_DIR), exist_ok=True)
+            _atomic_save(os.path.join(self.root, path), np.asarray(edges))
+        elif path not in self._edge_paths:
+            full_path = os.path.join(self.root, path)
+            if not os.path.exists(full_path):
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                _atomic_save(full_path, np.asarray(edges))
+            self._edge_paths.add(path)
+        return path
+
+    def close(self):
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class DatasetReader:
+    """
+    Random-access reader for a dataset written by DatasetWriter.
+
+    The shards are memory-mapped, so opening a dataset only reads its index and rooms are paged
+    in from disk as they are accessed. Datasets larger than RAM can be sampled randomly.
+
+    Parameters:
+    - root: Directory of the dataset
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.entries = read_index(root)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        return self.frequency_response(index)
+
+    def frequency_response(self, index, receivers=None, freqs=None):
+        """
+        Frequency responses of one room.
+
+        Slices of receivers and frequency bins are read-only views into the memory-mapped shard.
+        Index arrays only copy the selected receivers and bins. Rooms stored in a compact format
+        are decoded after the selection, so only the selected part is converted.
+
+        Parameters:
+        - index: Position of the room in the index
+        - receivers: Optional slice or indices of receivers (first axis)
+        - freqs: Optional slice or indices of frequency bins (second axis)
+
+        Returns:
+        - frequency_response: Array of size [nReceivers, nFreq, ...]
+        """
+        entry = self.entries[index]
+        if entry.get('storage', {}).get('format') == 'factorized':
+            response = self.room_response(index)
+            block = response[slice(None) if receivers is None else receivers,
+                             slice(None) if freqs is None else freqs]
+            return block if len(entry['shape']) == 3 else block[:, :, 0]
+
+        frequency_response = self.raw(index)
+        if receivers is not None:
+            frequency_response = frequency_response[receivers]
+        if freqs is not None:
+            frequency_response = frequency_response[:, freqs]
+        return decode_response(frequency_response, self.entries[index].get('storage', {'format': 'native'}))
+
+    def room_response(self, index, cache_size=16):
+        """
+        Lazily evaluated RoomResponse of a room stored in the 'factorized' format, rebuilt from
+        the stored mode table, mu and psi_s.
+        """
+        from green_3d_freq_modal_response import grid_factors
+        from room_response import RoomResponse
+
+        with np.load(os.path.join(self.root, self.entries[index]['path'])) as factors:
+            grid = grid_factors(self.setup(index), factors['modal_numbers'].astype(int), factors['scale'])
+            return RoomResponse(self.setup(index), grid, factors['mu'], factors['psi_s'],
+                                bins=self.entries[index].get('bins'), cache_size=cache_size)
+
+    def impulse_response(self, index, receivers=None, samples=None):
+        """
+        Impulse responses of one room, if they were stored, as a read-only memory-mapped view
+        for slices (size = [nReceivers, nSamples, ...]).
+        """
+        entry = self.entries[index]
+        if 'rir' not in entry:
+            raise KeyError(f"No impulse responses stored for room '{entry['name']}'.")
+        impulse_response = np.load(os.path.join(self.root, entry['rir']), mmap_mode='r')
+        if receivers is not None:
+            impulse_response = impulse_response[receivers]
+        if samples is not None:
+            impulse_response = impulse_response[:, samples]
+        return impulse_response
+
+    def raw(self, index):
+        """
+        Memory-mapped stored array of one room, before decoding.
+        """
+        return np.load(os.path.join(self.root, self.entries[index]['path']), mmap_mode='r')
+
+    def setup(self, index):
+        """
+        Setup dictionary the room was generated from. An observation grid left out by
+        compact_setup is regenerated.
+        """
+        Setup = self.entries[index]['Setup']
+        if 'Point' not in Setup['Observation']:
+            from SampleGrid import SampleGrid
+            SampleGrid(Setup)
+        return Setup
+
+    def edges(self, index):
+        """
+        Graph edges between the receivers of one room (size = [2, nEdges]), shared with all
+        rooms of the same receiver layout.
+        """
+        return np.load(os.path.join(self.root, self.entries[index]['edges']), mmap_mode='r')
+
+def compact_setup(Setup):
+    """
+    Copy of a setup for the index without the observation points, if they are the SampleGrid
+    grid and can be regenerated from the grid parameters.
+    """
+    from SampleGrid import SampleGrid
+
+    observation = {key: value for key, value in Setup['Observation'].items() if key != 'Point'}
+    grid = {'Observation': dict(observation)}
+    SampleGrid(grid)
+    if not np.array_equal(grid['Observation']['Point'], np.asarray(Setup['Observation']['Point'])):
+        return Setup
+    return {**Setup, 'Observation': observation}
+
+def read_index(root):
+    """
+    Read the index entries of a dataset, in the order the rooms were written.
+
+    A truncated last line, left behind by a crash while the index was being written, is ignored.
+    """
+    entries = []
+    with open(os.path.join(root, INDEX_FILE)) as f:
+        lines = f.readlines()
+    for line_number, line in enumerate(lines):
+        try:
+            entries.append(json.loads(line))
+        except json.JSONDecodeError:
+            if line_number != len(lines) - 1:
+                raise
+    return entries
+
+def repair_index(root):
+    """
+    Bring the index of an interrupted dataset back to a consistent state before appending.
+
+    Entries whose shard, impulse response or edge file is missing or unreadable are dropped, as is a truncated
+    last line, and the index is rewritten atomically. Temporary files of writes that never
+    completed are removed.
+
+    Returns:
+    - entries: The index entries kept
+    """
+    index_path = os.path.join(root, INDEX_FILE)
+    for directory in (ROOM_DIR, RIR_DIR, EDGE_DIR):
+        directory = os.path.join(root, directory)
+        for name in os.listdir(directory) if os.path.isdir(directory) else ():
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(directory, name))
+    if not os.path.exists(index_path):
+        return []
+
+    entries = [entry for entry in read_index(root) if _valid_entry(root, entry)]
+    with _atomic_open(index_path) as f:
+        for entry in entries:
+            f.write((json.dumps(entry) + '\n').encode())
+    return entries
+
+def merge_datasets(output, inputs, link=False):
+    """
+    Combine datasets generated separately, e.g. the seed-range shards of a distributed run,
+    into one dataset without rewriting the room data.
+
+    The merged index in output refers to the shards of the inputs by relative paths, so the
+    directories must keep their relative location. With link=True the shards are hard-linked
+    into output instead, which makes it self-contained (inputs on the same filesystem only).
+
+    Parameters:
+    - output: Directory of the merged dataset
+    - inputs: Directories of the datasets to merge
+
+    Returns:
+    - entries: Index entries of the merged dataset, sorted by seed
+    """
+    entries = []
+    for root in inputs:
+        if os.path.abspath(root) == os.path.abspath(output):
+            raise ValueError('The merged dataset must not be written into one of its inputs.')
+        for entry in read_index(root):
+            entry = dict(entry)
+            for key in ('path', 'edges', 'rir'):
+                if entry.get(key) is not None:
+                    entry[key] = os.path.join(root, entry[key])
+            entries.append(entry)
+
+    hashes = {entry.get('params_hash') for entry in entries}
+    if len(hashes) > 1:
+        raise ValueError(f'The datasets were generated with different parameters (hashes {sorted(map(str, hashes))}).')
+    seeds = [entry['seed'] for entry in entries]
+    if len(set(seeds)) != len(seeds):
+        raise ValueError('The datasets overlap: some seeds occur more than once.')
+
+    os.makedirs(output, exist_ok=True)
+    for entry in entries:
+        for key in ('path', 'edges', 'rir'):
+            if entry.get(key) is None:
+                continue
+            if link:
+                # Edge files are shared by the rooms of a dataset, so they may be linked already
+                target = os.path.join(os.path.basename(os.path.dirname(entry[key])), os.path.basename(entry[key]))
+                os.makedirs(os.path.join(output, os.path.dirname(target)), exist_ok=True)
+                if not os.path.exists(os.path.join(output, target)):
+                    os.link(entry[key], os.path.join(output, target))
+                entry[key] = target
+            else:
+                entry[key] = os.path.relpath(entry[key], output)
+
+    entries.sort(key=lambda entry: entry['seed'])
+    with _atomic_open(os.path.join(output, INDEX_FILE)) as f:
+        for entry in entries:
+            f.write((json.dumps(entry) + '\n').encode())
+    return entries
+
+def params_hash(params):
+    """
+    Short stable hash of a JSON-serializable dictionary of generation parameters.
+    """
+    text = json.dumps(params, sort_keys=True, default=_to_json)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+def _valid_entry(root, entry):
+    """
+    Check that the shard of an index entry is complete and matches the recorded shape.
+    """
+    try:
+        for key in ('edges', 'rir'):
+            if entry.get(key) is not None:
+                np.load(os.path.join(root, entry[key]), mmap_mode='r')
+        if entry.get('storage', {}).get('format') == 'factorized':
+            with np.load(os.path.join(root, entry['path'])) as factors:
+                return factors['mu'].shape[1] == entry['shape'][1] and len(factors['psi_s']) == len(factors['mu'])
+        data = np.load(os.path.join(root, entry['path']), mmap_mode='r')
+        return list(data.shape[:len(entry['shape'])]) == entry['shape']
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        return False
+
+def _atomic_save(path, array):
+    with _atomic_open(path) as f:
+        np.save(f, array)
+
+@contextmanager
+def _atomic_open(path):
+    """
+    Binary file that only replaces path once it has been written completely.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        yield f
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _to_json(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Merge datasets generated separately (e.g. seed-range shards) into one dataset.')
+    parser.add_argument('output', help='directory of the merged dataset')
+    parser.add_argument('inputs', nargs='+', help='directories of the datasets to merge')
+    parser.add_argument('--link', action='store_true', help='hard-link the shards into output instead of referring to them')
+    args = parser.parse_args()
+
+    entries = merge_datasets(args.output, args.inputs, link=args.link)
+    print(f"Merged {len(entries)} rooms into {args.output}")
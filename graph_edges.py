@@ -0,0 +1,93 @@
+from functools import lru_cache
+import numpy as np
+
+# Neighbour offsets [dy, dx] on the grid, one direction per undirected edge
+GRID_OFFSETS = {4: ((0, 1), (1, 0)),
+                8: ((0, 1), (1, 0), (1, 1), (1, -1))}
+
+@lru_cache(maxsize=32)
+def grid_edges(x_samples, y_samples, connectivity=4):
+    """
+    Edges between neighbouring receivers of a rectangular grid in COO format.
+
+    The receivers are numbered like Setup['Observation']['Point'], x fastest: receiver
+    iy * x_samples + ix is adjacent to its row neighbours (ix +- 1) and column neighbours
+    (iy +- 1), and also to its diagonal neighbours if connectivity is 8. Every edge is
+    listed in both directions. The result is cached per grid shape and shared read-only.
+
+    Parameters:
+    - x_samples: Number of receivers along x
+    - y_samples: Number of receivers along y
+    - connectivity: 4 or 8 neighbours
+
+    Returns:
+    - edges: Source and target receiver indices (size = [2, nEdges])
+    """
+    if connectivity not in GRID_OFFSETS:
+        raise ValueError(f'Invalid connectivity {connectivity}. Should be 4 or 8.')
+
+    index = np.arange(x_samples * y_samples).reshape(y_samples, x_samples)
+    sources, targets = [], []
+    for dy, dx in GRID_OFFSETS[connectivity]:
+        rows = slice(0, y_samples - dy)
+        source_cols = slice(max(0, -dx), x_samples - max(0, dx))
+        target_cols = slice(max(0, dx), x_samples - max(0, -dx))
+        sources.append(index[rows, source_cols].ravel())
+        targets.append(index[dy:, target_cols].ravel())
+
+    edges = _undirected(np.concatenate(sources), np.concatenate(targets))
+    edges.setflags(write=False)
+    return edges
+
+def knn_edges(points, k):
+    """
+    Edges from every point to its k nearest neighbours, for non-uniform point sets.
+
+    Parameters:
+    - points: Receiver positions (size = [nPoints, nDims])
+    - k: Number of neighbours of each point
+
+    Returns:
+    - edges: Source and target indices, listed in both directions (size = [2, nEdges])
+    """
+    from scipy.spatial import cKDTree
+
+    points = np.asarray(points, dtype=float)
+    k = min(k, len(points) - 1)
+    _, neighbours = cKDTree(points).query(points, k + 1)
+    sources = np.repeat(np.arange(len(points)), k)
+    targets = neighbours[:, 1:].ravel()
+    return _undirected(sources, targets)
+
+def radius_edges(points, radius):
+    """
+    Edges between all pairs of points closer than radius, for non-uniform point sets.
+
+    Parameters:
+    - points: Receiver positions (size = [nPoints, nDims])
+    - radius: Largest distance between connected points
+
+    Returns:
+    - edges: Source and target indices, listed in both directions (size = [2, nEdges])
+    """
+    from scipy.spatial import cKDTree
+
+    pairs = cKDTree(np.asarray(points, dtype=float)).query_pairs(radius, output_type='ndarray')
+    return _undirected(pairs[:, 0], pairs[:, 1])
+
+def to_csr(edges, num_nodes):
+    """
+    Adjacency matrix of an edge list as a scipy.sparse CSR matrix.
+    """
+    from scipy.sparse import csr_matrix
+
+    data = np.ones(edges.shape[1], dtype=np.int8)
+    return csr_matrix((data, (edges[0], edges[1])), shape=(num_nodes, num_nodes))
+
+def _undirected(sources, targets):
+    """
+    Stack both directions of every edge and drop duplicates, sorted by source then target.
+    """
+    edges = np.stack([np.concatenate([sources, targets]), np.concatenate([targets, sources])])
+    edges = np.unique(edges.astype(np.int64), axis=1)
+    return np.ascontiguousarray(edges)
@@ -1,13 +1,23 @@
+from functools import lru_cache, wraps
 import numpy as np
-from scipy.signal import butter, filtfilt
+from SampleGrid import grid_axes
+from backend import get_backend
 
-def green_3d_freq_modal_response(freq_lim, setup):
+# Number of parameter sets kept by each of the caches below
+CACHE_SIZE = 128
+
+def green_3d_freq_modal_response(freq_lim, setup, method='vectorized', bins=None, margin=None):
     """
     Calculate the modal response in the frequency domain for a lightly damped rectangular room.
     
     Parameters:
     - freq_lim: Highest eigenfunction resonance frequency included in the calculations
     - setup: Dictionary containing the configuration and parameters
+    - method: 'vectorized' evaluates all modes at once, 'loop' is the per-mode reference
+    - bins: Optional indices of the solution frequencies to evaluate (see frequency_bins).
+      Mu then only has these columns
+    - margin: If given, only modes with resonance frequencies within margin [Hz] of the
+      evaluated frequencies are included
     
     Returns:
     - Psi_r: Eigenfunctions evaluated at receiver positions (size = [rPos, nMod])
@@ -36,44 +46,42 @@ def green_3d_freq_modal_response(freq_lim, setup):
     tau_axial_z = V / (setup['Ambient']['c'] * beta) / (2 * 2 * (A_xy + A_xz / 2 + A_yz / 2))
     tau_compression = V / (setup['Ambient']['c'] * beta) / (2 * (A_xy + A_xz + A_yz))
     
-    # Determine solution frequencies
-    frequency = np.arange(0, setup['Fs']/2, 1/setup['Duration'])
-    w = 2 * np.pi * frequency
-    
-    # Low frequency rolloff of driver
-    B, A = butter(2, 2 * setup['Source']['Highpass'] / setup['Fs'], 'high')
-    imp = np.concatenate(([1], np.zeros(len(w) - 1)))
-    imp = filtfilt(B, A, imp)
-    
-    # High frequency rolloff / anti-aliasing filter
-    B, A = butter(2, 2 * setup['Source']['Lowpass'] / setup['Fs'])
-    imp = filtfilt(B, A, imp)
-    freq_win = np.fft.fft(imp, 2 * len(w))
-    freq_win = freq_win[:len(w)]
+    # Determine solution frequencies and the source filter window (cached per parameter set)
+    w, k = _wavenumbers(setup['Fs'], setup['Duration'], setup['Ambient']['c'])
+    freq_win = _frequency_window(setup['Fs'], setup['Duration'],
+                                 setup['Source']['Highpass'], setup['Source']['Lowpass'])
+    if bins is not None:
+        w, k, freq_win = w[bins], k[bins], freq_win[bins]
     
     # Extract coordinates
-    points = np.array([p for p in setup['Observation']['Point']])
-    sources = np.array([s for s in setup['Source']['Position']])
+    points = np.asarray(setup['Observation']['Point'], dtype=float)
+    sources = np.asarray(setup['Source']['Position'], dtype=float)
     
     x, y, z = points[:, 0], points[:, 1], points[:, 2]
     xS, yS, zS = sources[:, 0], sources[:, 1], sources[:, 2]
-    k = w / setup['Ambient']['c']
     
     # Determine relevant modal numbers
-    min_dim = np.min(setup['Room']['Dim'])
-    max_modal_number = np.ceil(2 * freq_lim * min_dim / setup['Ambient']['c'])
-    
-    modal_numbers = pick_n(np.arange(max_modal_number + 1), 3, 'all')
-    res_freqs = setup['Ambient']['c'] / (2 * np.pi) * np.sqrt(np.sum(
-        (np.pi * modal_numbers / setup['Room']['Dim'])**2, axis=1
-    ))
-    
-    sorted_idx = np.argsort(res_freqs)
-    res_freqs = res_freqs[sorted_idx]
-    modal_numbers = modal_numbers[sorted_idx]
-    
-    modal_numbers = modal_numbers[res_freqs < freq_lim]
-    km = 2 * np.pi * res_freqs[res_freqs < freq_lim] / setup['Ambient']['c']
+    modes = _modes_in_band(enumerate_modes(freq_lim, setup['Room']['Dim'], setup['Ambient']['c']), w, margin)
+    modal_numbers = np.stack([modes['nx'], modes['ny'], modes['nz']], axis=1)
+    km = 2 * np.pi * modes['f_res'] / setup['Ambient']['c']
+    
+    if method == 'vectorized':
+        mode_type = modes['mode_type']
+        scale = np.sqrt(2.0 ** _popcount(mode_type) / V)
+        psi_r = eigenfunctions(points, modal_numbers, setup['Room']['Dim'], scale)
+        psi_s = eigenfunctions(sources, modal_numbers, setup['Room']['Dim'], scale).T
+        
+        # Time constant per mode, looked up by which axes have a nonzero modal number
+        taus = np.array([tau_compression, tau_axial_x, tau_axial_y, tau_tangential_xy,
+                         tau_axial_z, tau_tangential_xz, tau_tangential_yz, tau_oblique])
+        
+        # mu is kept real, like the float buffer the loop reference assigns into
+        mu = get_backend().modal_mu(w, setup['Ambient']['c'], km, taus[mode_type], freq_win)
+        mu[:, w == 0] = 0  # Hardcode DC-component to zero
+        
+        return psi_r, mu, psi_s
+    elif method != 'loop':
+        raise ValueError(f"Unknown method '{method}'. Should be 'vectorized' or 'loop'.")
     
     # Calculate responses
     psi_s = np.zeros((len(km), len(setup['Source']['Position'])))
@@ -82,6 +90,7 @@ def green_3d_freq_modal_response(freq_lim, setup):
     
     for mode_index in range(len(modal_numbers)):
         eps = np.count_nonzero(modal_numbers[mode_index] > 0)
+        dim = eps
         eps = 2**eps if eps > 0 else 1
         
         psi_r[:, mode_index] = np.sqrt(eps / V) * (
@@ -95,33 +104,311 @@ def green_3d_freq_modal_response(freq_lim, setup):
             np.cos(modal_numbers[mode_index, 2] * np.pi * zS / setup['Room']['Dim'][2])
         )
         
-        if eps == 0:
+        if dim == 0:
             taum = tau_compression
-        elif eps == 1:
+        elif dim == 1:
             if modal_numbers[mode_index, 0] != 0:
                 taum = tau_axial_x
             elif modal_numbers[mode_index, 1] != 0:
                 taum = tau_axial_y
             else:
                 taum = tau_axial_z
-        elif eps == 2:
+        elif dim == 2:
             if modal_numbers[mode_index, 0] == 0:
                 taum = tau_tangential_yz
             elif modal_numbers[mode_index, 1] == 0:
                 taum = tau_tangential_xz
             else:
                 taum = tau_tangential_xy
-        elif eps == 3:
+        elif dim == 3:
             taum = tau_oblique
         else:
             raise ValueError('Invalid modal dimension. Should be between 0 and 3.')
         
         mu[mode_index, :] = -4 * np.pi / (k**2 - km[mode_index]**2 - 1j * k / (taum * setup['Ambient']['c'])) * freq_win
     
-    mu[:, 0] = 0  # Hardcode DC-component to zero
+    mu[:, w == 0] = 0  # Hardcode DC-component to zero
     
     return psi_r, mu, psi_s
 
+def frequency_bins(setup, freqs=None, band=None, bins=None):
+    """
+    Select solution frequencies np.arange(0, Fs / 2, 1 / Duration) to evaluate.
+    
+    Parameters:
+    - setup: Dictionary containing the configuration and parameters
+    - freqs: Explicit frequencies [Hz], each mapped to the nearest solution frequency
+    - band: Band limits [f_min, f_max] in Hz, both included
+    - bins: Indices of the solution frequencies
+    
+    Returns:
+    - bins: Indices of the selected solution frequencies, or None to evaluate all of them
+    """
+    n_freq = len(_wavenumbers(setup['Fs'], setup['Duration'], setup['Ambient']['c'])[0])
+    if freqs is not None:
+        bins = np.rint(np.asarray(freqs) * setup['Duration']).astype(int)
+    elif band is not None:
+        bins = np.arange(int(np.ceil(band[0] * setup['Duration'])), int(np.floor(band[1] * setup['Duration'])) + 1)
+    elif bins is None:
+        return None
+    bins = np.asarray(bins)
+    if bins.size and (bins.min() < 0 or bins.max() >= n_freq):
+        raise ValueError(f'Frequency bins must lie between 0 and {n_freq - 1}.')
+    return bins
+
+def _modes_in_band(modes, w, margin):
+    """
+    Drop the modes with resonance frequencies further than margin from the evaluated
+    frequencies, which contribute little in the band.
+    """
+    if margin is None or len(w) == 0:
+        return modes
+    frequency = w / (2 * np.pi)
+    in_band = (modes['f_res'] >= frequency.min() - margin) & (modes['f_res'] <= frequency.max() + margin)
+    return modes[in_band]
+
+def _mode_types(modal_numbers):
+    """
+    Encode which axes of each mode have a nonzero modal number as a bitmask (x = 1, y = 2, z = 4).
+    """
+    return (modal_numbers > 0) @ (1 << np.arange(modal_numbers.shape[1]))
+
+def _popcount(mode_type):
+    """
+    Number of nonzero modal numbers for each mode type bitmask.
+    """
+    return (mode_type & 1) + ((mode_type >> 1) & 1) + ((mode_type >> 2) & 1)
+
+def eigenfunctions(coords, modal_numbers, dims, scale):
+    """
+    Evaluate the eigenfunctions of all modes at a set of positions.
+    
+    A cosine table cos(n * pi * coord / L) is built once per axis for every modal number in
+    use, and the eigenfunctions are taken as products of its columns.
+    
+    Parameters:
+    - coords: Positions (size = [nPos, nAxes])
+    - modal_numbers: Integer modal numbers (size = [nMod, nAxes])
+    - dims: Room dimensions along each axis
+    - scale: Normalization sqrt(eps / V) of each mode (size = [nMod])
+    
+    Returns:
+    - Psi: Eigenfunctions evaluated at the positions (size = [nPos, nMod])
+    """
+    psi = None
+    for axis in range(modal_numbers.shape[1]):
+        table = _cosine_table(coords[:, axis], modal_numbers[:, axis].max(initial=0), dims[axis])
+        factor = table[:, modal_numbers[:, axis]]
+        psi = factor if psi is None else psi * factor
+    return scale * psi
+
+def eigenfunction_gradients(coords, modal_numbers, dims, scale):
+    """
+    Evaluate the analytic spatial gradients of the eigenfunctions of all modes.
+    
+    Parameters:
+    - coords: Positions (size = [nPos, nAxes])
+    - modal_numbers: Integer modal numbers (size = [nMod, nAxes])
+    - dims: Room dimensions along each axis
+    - scale: Normalization sqrt(eps / V) of each mode (size = [nMod])
+    
+    Returns:
+    - dPsi: Derivatives of the eigenfunctions along each axis (size = [nAxes, nPos, nMod])
+    """
+    n_axes = modal_numbers.shape[1]
+    wavenumbers = [modal_numbers[:, axis] * np.pi / dims[axis] for axis in range(n_axes)]
+    cosines = [np.cos(wavenumbers[axis] * coords[:, axis, None]) for axis in range(n_axes)]
+    gradients = np.empty((n_axes, len(coords), len(modal_numbers)))
+    for axis in range(n_axes):
+        gradients[axis] = -scale * wavenumbers[axis] * np.sin(wavenumbers[axis] * coords[:, axis, None])
+        for other in range(n_axes):
+            if other != axis:
+                gradients[axis] *= cosines[other]
+    return gradients
+
+def grid_factors(setup, modal_numbers, scale):
+    """
+    Per-axis factors of the receiver eigenfunctions on the SampleGrid grid of the setup.
+    """
+    if setup['Observation'].get('Adaptive'):
+        raise ValueError('The separable method requires the SampleGrid grid, not an adaptive point set.')
+    if setup['Observation']['zSamples'] != 1:
+        raise ValueError('The separable method requires a single grid layer (zSamples = 1).')
+    x_values, y_values, _ = grid_axes(setup)
+    return {'cos_x': _cosine_table(x_values, modal_numbers[:, 0].max(initial=0), setup['Room']['Dim'][0]),
+            'cos_y': _cosine_table(y_values, modal_numbers[:, 1].max(initial=0), setup['Room']['Dim'][1]),
+            'modal_numbers': modal_numbers,
+            'scale': scale}
+
+def _cosine_table(coords, max_modal_number, dim):
+    """
+    Cosine factors cos(n * pi * coord / L) of the eigenfunctions along one axis for
+    n = 0, ..., max_modal_number (size = [nPos, max_modal_number + 1]).
+    """
+    n = np.arange(max_modal_number + 1)
+    return np.cos(n * np.pi * coords[:, None] / dim)
+
+def clear_caches():
+    """
+    Empty the frequency window, wavenumber and mode enumeration caches.
+    """
+    for cached in (_frequency_window, _wavenumbers, enumerate_modes):
+        cached.cache_clear()
+
+def cache_info():
+    """
+    Hit and miss statistics of the frequency window, wavenumber and mode enumeration caches.
+    """
+    return {cached.__name__: cached.cache_info() for cached in (_frequency_window, _wavenumbers, enumerate_modes)}
+
+def _cached(function):
+    """
+    Bounded LRU cache keyed by hashable scalars and sequences; the returned arrays are read-only.
+    """
+    @lru_cache(maxsize=CACHE_SIZE)
+    def cached(*args):
+        result = function(*args)
+        for array in (result if isinstance(result, tuple) else (result,)):
+            array.setflags(write=False)
+        return result
+    
+    @wraps(function)
+    def wrapper(*args):
+        return cached(*(tuple(map(float, arg)) if np.ndim(arg) else float(arg) for arg in args))
+    wrapper.cache_info = cached.cache_info
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+@_cached
+def _frequency_window(fs, duration, highpass, lowpass):
+    """
+    Source filter window at the solution frequencies (driver rolloff and anti-aliasing filter).
+    """
+    n_freq = len(np.arange(0, fs / 2, 1 / duration))
+    
+    # Low frequency rolloff of driver
+    B, A = _butter2(highpass, fs, 'high')
+    imp = np.concatenate(([1], np.zeros(n_freq - 1)))
+    imp = _filtfilt(B, A, imp)
+    
+    # High frequency rolloff / anti-aliasing filter
+    B, A = _butter2(lowpass, fs, 'low')
+    imp = _filtfilt(B, A, imp)
+    freq_win = np.fft.fft(imp, 2 * n_freq)
+    return freq_win[:n_freq]
+
+# The window filters are those of scipy.signal.butter(2, ...) and scipy.signal.filtfilt, written
+# out for the second order so that the solver does not import scipy.signal, which takes about a
+# second, in every process
+
+def _butter2(cutoff, fs, btype):
+    """
+    Second-order digital Butterworth filter (bilinear transform with prewarping).
+    
+    Returns:
+    - b, a: Numerator and denominator coefficients (size = [3])
+    """
+    if not 0 < cutoff < fs / 2:
+        raise ValueError(f'Invalid {btype}pass cutoff {cutoff} Hz. Should be between 0 and Fs / 2 = {fs / 2} Hz.')
+    K = np.tan(np.pi * cutoff / fs)
+    norm = 1 + np.sqrt(2) * K + K ** 2
+    a = np.array([1, 2 * (K ** 2 - 1) / norm, (1 - np.sqrt(2) * K + K ** 2) / norm])
+    if btype == 'low':
+        b = K ** 2 / norm * np.array([1.0, 2.0, 1.0])
+    elif btype == 'high':
+        b = np.array([1.0, -2.0, 1.0]) / norm
+    else:
+        raise ValueError(f"Unknown filter type '{btype}'. Should be 'low' or 'high'.")
+    return b, a
+
+def _lfilter(b, a, x, zi):
+    """
+    Second-order IIR filter in transposed direct form II with initial state zi.
+    """
+    y = np.empty(len(x))
+    z0, z1 = zi
+    for n, value in enumerate(x):
+        y[n] = b[0] * value + z0
+        z0 = b[1] * value - a[1] * y[n] + z1
+        z1 = b[2] * value - a[2] * y[n]
+    return y
+
+def _filtfilt(b, a, x):
+    """
+    Zero-phase forward-backward filtering with odd extension of 3 * len(a) samples at both ends
+    and steady-state initial conditions, like scipy.signal.filtfilt(b, a, x).
+    """
+    pad = 3 * len(a)
+    if len(x) <= pad:
+        raise ValueError(f'Input of length {len(x)} is too short to filter. Should be longer than {pad} samples.')
+    ext = np.concatenate((2 * x[0] - x[pad:0:-1], x, 2 * x[-1] - x[-2:-pad - 2:-1]))
+    
+    # Steady state of the filter for a unit step input (scipy.signal.lfilter_zi)
+    companion = np.array([[-a[1], 1], [-a[2], 0]])
+    zi = np.linalg.solve(np.eye(2) - companion, b[1:] - a[1:] * b[0])
+    
+    y = _lfilter(b, a, ext, zi * ext[0])
+    y = _lfilter(b, a, y[::-1], zi * y[-1])[::-1]
+    return y[pad:-pad]
+
+@_cached
+def _wavenumbers(fs, duration, c):
+    """
+    Angular frequencies and wavenumbers of the solution frequencies.
+    """
+    frequency = np.arange(0, fs / 2, 1 / duration)
+    w = 2 * np.pi * frequency
+    return w, w / c
+
+# Structured dtype of the mode tables returned by enumerate_modes
+MODE_DTYPE = np.dtype([('nx', np.int32), ('ny', np.int32), ('nz', np.int32),
+                       ('f_res', np.float64), ('mode_type', np.uint8)])
+
+@_cached
+def enumerate_modes(freq_lim, dims, c):
+    """
+    Enumerate the modes of a rectangular room with resonance frequencies below freq_lim.
+    
+    Only modal numbers inside the ellipsoid f_res < freq_lim are generated: the bound for each
+    axis follows from its own room dimension and from the modal numbers already chosen on the
+    previous axes, so no combinations outside the ellipsoid are built.
+    
+    Parameters:
+    - freq_lim: Highest eigenfunction resonance frequency included
+    - dims: Room dimensions, [x, y] for the z = 0 plane or [x, y, z]
+    - c: Speed of sound
+    
+    Returns:
+    - modes: Structured array (dtype MODE_DTYPE) sorted according to resonance frequency, with
+      the modal numbers nx, ny, nz (nz = 0 in 2-D), resonance frequency f_res and mode_type,
+      the bitmask of axes with a nonzero modal number (x = 1, y = 2, z = 4)
+    """
+    dims = np.array(dims)
+    
+    # Squared radius left in units of (n / L) after choosing the modal numbers on previous axes
+    modal_numbers = np.zeros((1, 0), dtype=int)
+    remaining = np.array([(2 * freq_lim / c) ** 2])
+    for dim in dims:
+        # One extra candidate per axis guards against rounding in the square root
+        counts = np.floor(dim * np.sqrt(np.maximum(remaining, 0))).astype(int) + 2
+        starts = np.cumsum(counts) - counts
+        n = np.arange(counts.sum()) - np.repeat(starts, counts)
+        modal_numbers = np.column_stack([np.repeat(modal_numbers, counts, axis=0), n])
+        remaining = np.repeat(remaining, counts) - (n / dim) ** 2
+    
+    res_freqs = c / (2 * np.pi) * np.sqrt(np.sum((np.pi * modal_numbers / dims) ** 2, axis=1))
+    valid_indices = res_freqs < freq_lim
+    modal_numbers = modal_numbers[valid_indices]
+    res_freqs = res_freqs[valid_indices]
+    sorted_idx = np.argsort(res_freqs, kind='stable')
+    
+    modes = np.zeros(len(sorted_idx), dtype=MODE_DTYPE)
+    for axis, name in enumerate(('nx', 'ny', 'nz')[:len(dims)]):
+        modes[name] = modal_numbers[sorted_idx, axis]
+    modes['f_res'] = res_freqs[sorted_idx]
+    modes['mode_type'] = _mode_types(modal_numbers[sorted_idx])
+    return modes
+
 def pick_n(a, n, p):
     """
     Returns p random picks of n items from vector a.
@@ -138,81 +425,67 @@ def pick_n(a, n, p):
     else:
         return picks[choice(picks.shape[0], p, replace=False)]
 
-def green_3d_freq_modal_response_z0(freq_lim, setup):
+def green_3d_freq_modal_response_z0(freq_lim, setup, method='vectorized', bins=None, margin=None):
     """
     Calculate the modal response in the frequency domain for a lightly damped rectangular room.
     
     Parameters:
     - freq_lim: Highest eigenfunction resonance frequency included in the calculations
     - setup: Dictionary containing the configuration and parameters
+    - method: 'vectorized' evaluates all modes at once, 'loop' is the per-mode reference.
+      'separable' requires the receivers to be the SampleGrid grid of the setup and returns the
+      per-axis factors of Psi_r instead of Psi_r itself (see modal_sum.separable_modal_sum)
+    - bins: Optional indices of the solution frequencies to evaluate (see frequency_bins).
+      Mu then only has these columns
+    - margin: If given, only modes with resonance frequencies within margin [Hz] of the
+      evaluated frequencies are included
     
     Returns:
     - Psi_s: Eigenfunctions evaluated at source positions (size = [nMod, sPos])
-    - Psi_r: Eigenfunctions evaluated at receiver positions (size = [rPos, nMod])
+    - Psi_r: Eigenfunctions evaluated at receiver positions (size = [rPos, nMod]). For the
+      'separable' method a dictionary with the cosine tables 'cos_x' (size = [xSamples, nx + 1])
+      and 'cos_y' (size = [ySamples, ny + 1]), the 'modal_numbers' (size = [nMod, 2]) and the
+      normalization 'scale' (size = [nMod]) of the modes, such that
+      Psi_r[iy * xSamples + ix, m] = scale[m] * cos_x[ix, nx[m]] * cos_y[iy, ny[m]]
     - Mu: Eigenvalues of the eigenfunctions at each excitation frequency (size = [nMod, nFreq])
     """
     
     # Initialize parameters for the room
     V = np.prod(setup['Room']['Dim'])
-    A_xy = np.prod(setup['Room']['Dim'][:2])
-    A_yz = np.prod(setup['Room']['Dim'][1:])
-    A_xz = np.prod([setup['Room']['Dim'][0], setup['Room']['Dim'][2]])
-    S = 2 * (A_xy + A_yz + A_xz)
+    tau_compression, tau_axial, tau_tangential = _time_constants_z0(setup)
     
-    # Absorption coefficient
-    alpha = 24 * np.log(10) / setup['Ambient']['c'] * V / (S * setup['Room']['ReverbTime'])
-    beta = alpha / 8
-    
-    # Time constants for different mode types
-    tau_oblique = V / (2 * setup['Ambient']['c'] * S * beta)
-    tau_tangential = 3 * V / (5 * setup['Ambient']['c'] * S * beta)
-    tau_axial = 3 * V / (4 * setup['Ambient']['c'] * S * beta)
-    tau_compression = V / (setup['Ambient']['c'] * beta) * 1 / S
-    
-    # Determine solution frequencies
-    frequency = np.arange(0, setup['Fs'] / 2, 1 / setup['Duration'])
-    w = 2 * np.pi * frequency
-    
-    # Low frequency rolloff of driver
-    B, A = butter(2, 2 * setup['Source']['Highpass'] / setup['Fs'], 'high')
-    imp = np.concatenate(([1], np.zeros(len(w) - 1)))
-    imp = filtfilt(B, A, imp)
-    
-    # High frequency rolloff / anti-aliasing filter
-    B, A = butter(2, 2 * setup['Source']['Lowpass'] / setup['Fs'])
-    imp = filtfilt(B, A, imp)
-    freq_win = np.fft.fft(imp, 2 * len(w))
-    freq_win = freq_win[:len(w)]
+    # Determine solution frequencies and the source filter window (cached per parameter set)
+    w, k = _wavenumbers(setup['Fs'], setup['Duration'], setup['Ambient']['c'])
+    freq_win = _frequency_window(setup['Fs'], setup['Duration'],
+                                 setup['Source']['Highpass'], setup['Source']['Lowpass'])
+    if bins is not None:
+        w, k, freq_win = w[bins], k[bins], freq_win[bins]
     
     # Extract coordinates
-    points = np.array([p for p in setup['Observation']['Point']])
-    sources = np.array([s for s in setup['Source']['Position']])
+    points = np.asarray(setup['Observation']['Point'], dtype=float)
+    sources = np.asarray(setup['Source']['Position'], dtype=float)
     
     x, y = points[:, 0], points[:, 1]
     x_s, y_s = sources[:, 0], sources[:, 1]
-    k = w / setup['Ambient']['c']
-    
-    # Frequency limit for modes
-    min_dim = np.min(setup['Room']['Dim'][:2])
-    max_modal_number = np.ceil(2 * freq_lim * min_dim / setup['Ambient']['c'])
     
-    # Create list of all possible combinations of modal numbers
-    modal_numbers = pick_n(np.arange(max_modal_number + 1), 2, 'all')
+    # Modes with resonance frequencies below freq_lim, sorted according to resonance frequency
+    modes = select_modes_z0(freq_lim, setup, bins, margin)
+    modal_numbers = np.stack([modes['nx'], modes['ny']], axis=1)
+    km = 2 * np.pi * modes['f_res'] / setup['Ambient']['c']
     
-    # Calculate resonance frequencies corresponding to the list of modal numbers
-    res_freqs = setup['Ambient']['c'] / (2 * np.pi) * np.sqrt(
-        np.sum((np.pi * modal_numbers / setup['Room']['Dim'][:2]) ** 2, axis=1)
-    )
-    
-    # Sort modes according to resonance frequency
-    sorted_idx = np.argsort(res_freqs)
-    res_freqs = res_freqs[sorted_idx]
-    modal_numbers = modal_numbers[sorted_idx, :]
-    
-    # Prune the list of modes to only include modes with resonance frequencies below freq_lim
-    valid_indices = res_freqs < freq_lim
-    modal_numbers = modal_numbers[valid_indices, :]
-    km = 2 * np.pi * res_freqs[valid_indices] / setup['Ambient']['c']
+    if method in ('vectorized', 'separable'):
+        mode_type = modes['mode_type']
+        scale = np.sqrt(2.0 ** _popcount(mode_type) / V)
+        if method == 'separable':
+            psi_r = grid_factors(setup, modal_numbers, scale)
+        else:
+            psi_r = eigenfunctions(points[:, :2], modal_numbers, setup['Room']['Dim'][:2], scale)
+        psi_s = eigenfunctions(sources[:, :2], modal_numbers, setup['Room']['Dim'][:2], scale).T
+        mu = modal_mu_z0(setup, modes, bins)
+        
+        return psi_r, mu, psi_s
+    elif method != 'loop':
+        raise ValueError(f"Unknown method '{method}'. Should be 'vectorized', 'separable' or 'loop'.")
     
     # Calculate responses
     psi_s = np.zeros((len(km), len(setup['Source']['Position'])))
@@ -246,10 +519,222 @@ def green_3d_freq_modal_response_z0(freq_lim, setup):
         im = k / (taum * setup['Ambient']['c'])
         mu[mode_index, :] = -4 * np.pi / (re - 1j * im + 1e-5) * freq_win
         
-    mu[:, 0] = 0  # Hardcode DC-component to zero
+    mu[:, w == 0] = 0  # Hardcode DC-component to zero
 
     return psi_r, mu, psi_s
 
+def select_modes_z0(freq_lim, setup, bins=None, margin=None, modes=None):
+    """
+    Mode table of a room in the z = 0 plane solved by green_3d_freq_modal_response_z0: the modes
+    below freq_lim, restricted to those within margin of the evaluated frequencies.
+    
+    If modes is given, the modes are selected from this table instead of enumerated. It must
+    contain all modes of the room below freq_lim, e.g. those enumerated for a lower speed of
+    sound; their resonance frequencies are recomputed for the speed of sound of setup.
+    """
+    dims, c = setup['Room']['Dim'][:2], setup['Ambient']['c']
+    if modes is None:
+        modes = enumerate_modes(freq_lim, dims, c)
+    else:
+        # The same expression as in enumerate_modes, so the table equals the enumerated one
+        modal_numbers = np.stack([modes['nx'], modes['ny']], axis=1)
+        res_freqs = c / (2 * np.pi) * np.sqrt(np.sum((np.pi * modal_numbers / np.array(dims)) ** 2, axis=1))
+        modes = modes[res_freqs < freq_lim]
+        modes['f_res'] = res_freqs[res_freqs < freq_lim]
+    w = _wavenumbers(setup['Fs'], setup['Duration'], c)[0]
+    if bins is not None:
+        w = w[bins]
+    return _modes_in_band(modes, w, margin)
+
+def modal_factors_z0(setup, modes, sources=None):
+    """
+    Modal numbers, normalization and source eigenfunctions of the modes of a room in the
+    z = 0 plane.
+    
+    Parameters:
+    - setup: Dictionary containing the configuration and parameters
+    - modes: Mode table of the room (see select_modes_z0)
+    - sources: Optional source positions (size = [sPos, 3]) instead of those of setup
+    
+    Returns:
+    - modal_numbers: Modal numbers nx, ny of the modes (size = [nMod, 2])
+    - scale: Normalization sqrt(eps / V) of each mode (size = [nMod])
+    - Psi_s: Eigenfunctions evaluated at source positions (size = [nMod, sPos])
+    """
+    dims = setup['Room']['Dim']
+    if sources is None:
+        sources = setup['Source']['Position']
+    modal_numbers = np.stack([modes['nx'], modes['ny']], axis=1)
+    scale = np.sqrt(2.0 ** _popcount(modes['mode_type']) / np.prod(dims))
+    psi_s = eigenfunctions(np.asarray(sources, dtype=float)[:, :2], modal_numbers, dims[:2], scale).T
+    return modal_numbers, scale, psi_s
+
+def modal_mu_z0(setup, modes, bins=None, complex_valued=False):
+    """
+    Eigenvalues mu of the modes of a room in the z = 0 plane. They depend on the room, the
+    reverberation time and the speed of sound, but not on the receiver and source positions.
+    
+    Parameters:
+    - setup: Dictionary containing the configuration and parameters
+    - modes: Mode table of the room (see enumerate_modes)
+    - bins: Optional indices of the solution frequencies to evaluate (see frequency_bins)
+    - complex_valued: Return the complex eigenvalues instead of their real part, which the
+      solvers use. The phase is needed for impulse responses
+    
+    Returns:
+    - Mu: Eigenvalues of the eigenfunctions at each excitation frequency (size = [nMod, nFreq])
+    """
+    w = _wavenumbers(setup['Fs'], setup['Duration'], setup['Ambient']['c'])[0]
+    freq_win = _frequency_window(setup['Fs'], setup['Duration'],
+                                 setup['Source']['Highpass'], setup['Source']['Lowpass'])
+    if bins is not None:
+        w, freq_win = w[bins], freq_win[bins]
+    km = 2 * np.pi * modes['f_res'] / setup['Ambient']['c']
+    
+    # Time constant per mode, looked up by which axes have a nonzero modal number
+    tau_compression, tau_axial, tau_tangential = _time_constants_z0(setup)
+    taus = np.array([tau_compression, tau_axial, tau_axial, tau_tangential])
+    
+    # The solvers take the real part, like the float buffer the loop reference assigns into;
+    # complex_valued keeps the phase of the eigenvalues
+    modal_mu = get_backend().modal_mu_complex if complex_valued else get_backend().modal_mu
+    mu = modal_mu(w, setup['Ambient']['c'], km, taus[modes['mode_type']], freq_win, offset=1e-5)
+    mu[:, w == 0] = 0  # Hardcode DC-component to zero
+    return mu
+
+def _time_constants_z0(setup):
+    """
+    Decay time constants of the compression, axial and tangential modes of a room in the
+    z = 0 plane, from its reverberation time.
+    """
+    return _time_constants(setup['Room']['Dim'], setup['Ambient']['c'], setup['Room']['ReverbTime'])
+
+def _time_constants(dims, c, reverb_time):
+    """
+    Decay time constants of the compression, axial and tangential modes, for one room or
+    elementwise for many (dims of size = [..., 3], c and reverb_time of size = [...]).
+    """
+    dims = np.asarray(dims, dtype=float)
+    V = np.prod(dims, axis=-1)
+    A_xy = dims[..., 0] * dims[..., 1]
+    A_yz = dims[..., 1] * dims[..., 2]
+    A_xz = dims[..., 0] * dims[..., 2]
+    S = 2 * (A_xy + A_yz + A_xz)
+    
+    # Absorption coefficient
+    alpha = 24 * np.log(10) / c * V / (S * reverb_time)
+    beta = alpha / 8
+    
+    tau_tangential = 3 * V / (5 * c * S * beta)
+    tau_axial = 3 * V / (4 * c * S * beta)
+    tau_compression = V / (c * beta) * 1 / S
+    return tau_compression, tau_axial, tau_tangential
+
+def green_3d_freq_modal_response_z0_batch(freq_lim, setups, bins=None, margin=None):
+    """
+    Solve the modal decomposition of a stack of rooms in the z = 0 plane at once.
+    
+    The rooms may differ in dimensions, reverberation time, speed of sound and source positions,
+    but share the sampling parameters, source filter, grid shape and number of sources. Their
+    modes are padded to the largest mode count, so mu of all rooms is computed in one array
+    expression and the responses can be assembled with modal_sum.batched_separable_modal_sum.
+    Padded modes have zero scale, mu and psi_s and are flagged in grid['mask'].
+    
+    Parameters:
+    - freq_lim: Highest eigenfunction resonance frequency included in the calculations
+    - setups: Sequence of setup dictionaries
+    - bins: Optional indices of the solution frequencies to evaluate (see frequency_bins)
+    - margin: If given, only modes with resonance frequencies within margin [Hz] of the
+      evaluated frequencies are included
+    
+    Returns:
+    - Psi_r: Dictionary with the per-room factors of the 'separable' method, stacked along a
+      leading room axis: 'cos_x' (size = [nRooms, xSamples, nx + 1]), 'cos_y'
+      (size = [nRooms, ySamples, ny + 1]), 'modal_numbers' (size = [nRooms, nMod, 2]), 'scale'
+      (size = [nRooms, nMod]) and 'mask' (size = [nRooms, nMod]), True for the modes of the room
+    - Mu: Eigenvalues of the eigenfunctions at each excitation frequency (size = [nRooms, nMod, nFreq])
+    - Psi_s: Eigenfunctions evaluated at source positions (size = [nRooms, nMod, sPos])
+    """
+    shared = {'Fs': lambda s: s['Fs'], 'Duration': lambda s: s['Duration'],
+              'Highpass': lambda s: s['Source']['Highpass'], 'Lowpass': lambda s: s['Source']['Lowpass'],
+              'SrcNum': lambda s: len(s['Source']['Position']),
+              'grid shape': lambda s: (s['Observation']['xSamples'], s['Observation']['ySamples'], s['Observation']['zSamples'])}
+    for name, value in shared.items():
+        values = {value(setup) for setup in setups}
+        if len(values) > 1:
+            raise ValueError(f'Batched rooms must share {name}, got {sorted(values)}.')
+    setup = setups[0]
+    if any(s['Observation'].get('Adaptive') for s in setups):
+        raise ValueError('The batched solver requires the SampleGrid grid, not an adaptive point set.')
+    if setup['Observation']['zSamples'] != 1:
+        raise ValueError('The batched solver requires a single grid layer (zSamples = 1).')
+    
+    # Room parameters, one row per room
+    dims = np.array([s['Room']['Dim'] for s in setups], dtype=float)
+    c = np.array([s['Ambient']['c'] for s in setups], dtype=float)[:, None, None]
+    V = np.prod(dims, axis=1)
+    reverb_times = np.array([s['Room']['ReverbTime'] for s in setups], dtype=float)
+    
+    # Time constants per room (rows) and mode type (columns: compression, axial x, axial y, tangential)
+    tau_compression, tau_axial, tau_tangential = _time_constants(dims, c[:, 0, 0], reverb_times)
+    taus = np.stack([tau_compression, tau_axial, tau_axial, tau_tangential], axis=1)
+    
+    # Shared solution frequencies and source filter window
+    w = _wavenumbers(setup['Fs'], setup['Duration'], setup['Ambient']['c'])[0]
+    freq_win = _frequency_window(setup['Fs'], setup['Duration'],
+                                 setup['Source']['Highpass'], setup['Source']['Lowpass'])
+    if bins is not None:
+        w, freq_win = w[bins], freq_win[bins]
+    
+    # Mode tables padded to the largest number of modes
+    tables = [_modes_in_band(enumerate_modes(freq_lim, s['Room']['Dim'][:2], s['Ambient']['c']), w, margin)
+              for s in setups]
+    n_rooms, n_mod = len(tables), max(len(modes) for modes in tables)
+    modes = np.zeros((n_rooms, n_mod), dtype=MODE_DTYPE)
+    mask = np.arange(n_mod) < np.array([len(table) for table in tables])[:, None]
+    modes[mask] = np.concatenate(tables)
+    modal_numbers = np.stack([modes['nx'], modes['ny']], axis=2)
+    
+    mode_type = modes['mode_type']
+    scale = np.where(mask, np.sqrt(2.0 ** _popcount(mode_type) / V[:, None]), 0)
+    taum = np.take_along_axis(taus, mode_type.astype(int), axis=1)
+    
+    # mu of the modes of all rooms in one evaluation, like the single-room solver
+    km = 2 * np.pi * modes['f_res'] / c[:, :, 0]
+    mu = get_backend().modal_mu(w, np.repeat(c[:, 0, 0], n_mod), km.ravel(), taum.ravel(), freq_win,
+                                offset=1e-5).reshape(n_rooms, n_mod, len(w))
+    mu[:, :, w == 0] = 0  # Hardcode DC-component to zero
+    mu[~mask] = 0
+    
+    # Cosine tables of the grid and the sources, with the room dimensions as the outer axis
+    axes = np.array([grid_axes(s)[:2] for s in setups])
+    sources = np.array([s['Source']['Position'] for s in setups], dtype=float)
+    n_x = np.arange(modal_numbers[:, :, 0].max(initial=0) + 1)
+    n_y = np.arange(modal_numbers[:, :, 1].max(initial=0) + 1)
+    grid = {'cos_x': np.cos(n_x * np.pi * axes[:, 0, :, None] / dims[:, 0, None, None]),
+            'cos_y': np.cos(n_y * np.pi * axes[:, 1, :, None] / dims[:, 1, None, None]),
+            'modal_numbers': modal_numbers,
+            'scale': scale,
+            'mask': mask}
+    psi_s = scale[:, :, None] * (
+        np.cos(modal_numbers[:, :, 0, None] * np.pi * sources[:, None, :, 0] / dims[:, 0, None, None]) *
+        np.cos(modal_numbers[:, :, 1, None] * np.pi * sources[:, None, :, 1] / dims[:, 1, None, None]))
+    
+    return grid, mu, psi_s
+
+def unbatch_factors(grid, mu, psi_s, index):
+    """
+    Factors of room index of a batched solve, in the layout of the 'separable' method of
+    green_3d_freq_modal_response_z0, with the padded modes removed.
+    """
+    mask = grid['mask'][index]
+    modal_numbers = grid['modal_numbers'][index][mask].astype(int)
+    room_grid = {'cos_x': grid['cos_x'][index][:, :modal_numbers[:, 0].max(initial=0) + 1],
+                 'cos_y': grid['cos_y'][index][:, :modal_numbers[:, 1].max(initial=0) + 1],
+                 'modal_numbers': modal_numbers,
+                 'scale': grid['scale'][index][mask]}
+    return room_grid, mu[index][mask], psi_s[index][mask]
+
 # Example usage
 if __name__ == "__main__":
     setup = {
@@ -0,0 +1,74 @@
+import numpy as np
+from green_3d_freq_modal_response import eigenfunctions, grid_factors, modal_factors_z0, modal_mu_z0, select_modes_z0
+from modal_sum import modal_sum, separable_modal_sum
+
+def impulse_responses(frequency_response, setup, bins=None, length=None, axis=1):
+    """
+    Room impulse responses from the frequency responses, with one real inverse FFT over all
+    receivers (and sources).
+
+    The solution frequencies np.arange(0, Fs / 2, 1 / Duration) are the non-negative bins of a
+    2 * nFreq point real FFT, the length the source filter window is built with, so the impulse
+    responses are sampled at Fs and last Duration seconds. The Nyquist bin is taken as zero.
+    The spectra must be complex: the real-valued responses of the solvers give zero-phase,
+    time-symmetric signals. Use room_impulse_responses for the impulse responses of a room.
+
+    Parameters:
+    - frequency_response: Transfer functions (size = [rPos, nFreq, ...] for axis = 1)
+    - setup: Dictionary containing the configuration and parameters
+    - bins: Indices of the solution frequencies if only these were computed (see
+      frequency_bins). The other bins are taken as zero
+    - length: Optional number of samples to keep from the start of each impulse response
+    - axis: Frequency axis of frequency_response
+
+    Returns:
+    - rir: Impulse responses, with the frequency axis replaced by time
+      (size = [rPos, length or 2 * nFreq, ...] for axis = 1)
+    """
+    n_freq = len(np.arange(0, setup['Fs'] / 2, 1 / setup['Duration']))
+    spectrum = np.moveaxis(np.asarray(frequency_response), axis, -1)
+    if bins is not None:
+        full = np.zeros(spectrum.shape[:-1] + (n_freq,), dtype=spectrum.dtype)
+        full[..., bins] = spectrum
+        spectrum = full
+    elif spectrum.shape[-1] != n_freq:
+        raise ValueError(f'Expected {n_freq} frequency bins, got {spectrum.shape[-1]}. Pass the bins of a band-limited response.')
+
+    rir = np.fft.irfft(spectrum, n=2 * n_freq, axis=-1)
+    if length is not None:
+        rir = rir[..., :length]
+    return np.ascontiguousarray(np.moveaxis(rir, -1, axis))
+
+def room_impulse_responses(setup, freq_lim=400, bins=None, margin=None, length=None):
+    """
+    Room impulse responses at all receivers of a room in the z = 0 plane, from the complex
+    modal eigenvalues.
+
+    The inverse FFT is linear, so it is applied per mode to the complex mu (see
+    impulse_responses) and the modal impulse responses are then summed like the frequency
+    responses, in real arithmetic: on the SampleGrid grid with separable_modal_sum, at other
+    receivers (e.g. adaptive_grid) with modal_sum. Truncating to length before the sum also
+    shortens the sum.
+
+    Parameters:
+    - setup: Dictionary containing the configuration and parameters
+    - freq_lim: Highest eigenfunction resonance frequency included in the calculations
+    - bins: Indices of the solution frequencies if the response is band-limited (see
+      frequency_bins). The other bins are taken as zero
+    - margin: If given, only modes resonating within margin [Hz] of the evaluated frequencies
+      are included
+    - length: Optional number of samples to keep from the start of each impulse response
+
+    Returns:
+    - rir: Impulse responses sampled at Fs (size = [rPos, length or Fs * Duration, sPos])
+    """
+    modes = select_modes_z0(freq_lim, setup, bins, margin)
+    mu = modal_mu_z0(setup, modes, bins, complex_valued=True)
+    modal_rir = impulse_responses(mu, setup, bins=bins, length=length)
+
+    dims = setup['Room']['Dim']
+    modal_numbers, scale, psi_s = modal_factors_z0(setup, modes)
+    if setup['Observation'].get('Adaptive'):
+        points = np.asarray(setup['Observation']['Point'], dtype=float)
+        return modal_sum(eigenfunctions(points[:, :2], modal_numbers, dims[:2], scale), modal_rir, psi_s)
+    return separable_modal_sum(grid_factors(setup, modal_numbers, scale), modal_rir, psi_s)
@@ -1,7 +1,7 @@
 import numpy as np
 from SampleGrid import SampleGrid
 
-def create_setup(seed=0, equidistant=False):
+def create_setup(seed=0, equidistant=False, num_sources=1):
     Setup = {}
 
     # ===========================
@@ -16,30 +16,8 @@ def create_setup(seed=0, equidistant=False):
     # ===========================
     #       Ambient
     # ---------------------------
-    # Ambient temperature [deg C]
-    Setup['Ambient'] = {}
-    Setup['Ambient']['Temp'] = 20
-
-    # Ambient pressure [Pa]
-    Setup['Ambient']['Pressure'] = 1000e2
-
-    # Specific heat capacity of dry air, sea level, 0 deg C
-    # Isobaric molar heat capacity [J/mol deg K]
-    cp = 29.07
-    # Isochore molar heat capacity [J/mol deg K]
-    cv = 20.7643
-
-    # Ratio of specific heats
-    gamma = cp / cv
-
-    # Ideal gas constant [J/kg deg K]
-    R = 287
-
-    # Density of air [kg/m3]
-    Setup['Ambient']['rho'] = Setup['Ambient']['Pressure'] / (R * (Setup['Ambient']['Temp'] + 273.15))
-
-    # Speed of sound [m/s]
-    Setup['Ambient']['c'] = np.sqrt(gamma * Setup['Ambient']['Pressure'] / Setup['Ambient']['rho'])
+    # Ambient temperature [deg C] and pressure [Pa]
+    Setup['Ambient'] = ambient(temp=20, pressure=1000e2)
 
     # ===========================
     #       Room
@@ -68,11 +46,11 @@ def create_setup(seed=0, equidistant=False):
     # Source higher cutoff frequency
     Setup['Source']['Lowpass'] = 500  # [Hz]
 
-    # Source position [x, y, z] [m]
-    sx = Setup['Room']['Dim'][0] * rng.random()
-    sy = Setup['Room']['Dim'][1] * rng.random()
+    # Source positions [x, y, z] [m], one row per source. The first source is drawn like a
+    # single source, so its position does not depend on num_sources
+    sxy = rng.random((num_sources, 2)) * [x, y]
     sz = 0
-    Setup['Source']['Position'] = [[sx, sy, sz]]
+    Setup['Source']['Position'] = [[sx, sy, sz] for sx, sy in sxy.tolist()]
     Setup['Source']['SrcNum'] = len(Setup['Source']['Position'])
 
     # ===========================
@@ -104,6 +82,32 @@ def create_setup(seed=0, equidistant=False):
     SampleGrid(Setup)
     return Setup
 
+def ambient(temp=20, pressure=1000e2):
+    """
+    Ambient parameters of dry air at a temperature [deg C] and pressure [Pa], with the derived
+    density 'rho' [kg/m3] and speed of sound 'c' [m/s].
+    """
+    Ambient = {'Temp': temp, 'Pressure': pressure}
+
+    # Specific heat capacity of dry air, sea level, 0 deg C
+    # Isobaric molar heat capacity [J/mol deg K]
+    cp = 29.07
+    # Isochore molar heat capacity [J/mol deg K]
+    cv = 20.7643
+
+    # Ratio of specific heats
+    gamma = cp / cv
+
+    # Ideal gas constant [J/kg deg K]
+    R = 287
+
+    # Density of air [kg/m3]
+    Ambient['rho'] = Ambient['Pressure'] / (R * (Ambient['Temp'] + 273.15))
+
+    # Speed of sound [m/s]
+    Ambient['c'] = np.sqrt(gamma * Ambient['Pressure'] / Ambient['rho'])
+    return Ambient
+
 # Call the init function
 if __name__ == "__main__":
     from pprint import pprint
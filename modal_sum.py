@@ -0,0 +1,167 @@
+import numpy as np
+from backend import get_backend
+
+def modal_sum(psi_r, mu, psi_s, out=None, order=None):
+    """
+    Assemble the transfer functions from the modal decomposition in one batched contraction.
+
+    Computes H[r, f, s] = sum_m psi_r[r, m] * mu[m, f] * psi_s[m, s] without building a
+    diagonal nMod x nMod matrix for every frequency bin.
+
+    Parameters:
+    - psi_r: Eigenfunctions evaluated at receiver positions (size = [rPos, nMod])
+    - mu: Eigenvalues of the eigenfunctions at each excitation frequency (size = [nMod, nFreq])
+    - psi_s: Eigenfunctions evaluated at source positions (size = [nMod, sPos])
+    - out: Optional C-contiguous output buffer (size = [rPos, nFreq, sPos])
+    - order: Contraction order, 'frequency' or 'receiver'. Picked from the sizes if None
+
+    Returns:
+    - H: Transfer functions between every source and receiver (size = [rPos, nFreq, sPos])
+    """
+    psi_r = np.asarray(psi_r)
+    mu = np.asarray(mu)
+    psi_s = np.asarray(psi_s)
+    n_rec, n_mod = psi_r.shape
+    n_freq = mu.shape[1]
+    n_src = psi_s.shape[1]
+
+    if out is None:
+        out = np.empty((n_rec, n_freq, n_src), dtype=np.result_type(psi_r, mu, psi_s))
+    elif out.shape != (n_rec, n_freq, n_src):
+        raise ValueError(f'Output buffer has shape {out.shape}, expected {(n_rec, n_freq, n_src)}.')
+
+    if order is None:
+        order = contraction_order(n_rec, n_mod, n_freq, n_src)
+
+    if order == 'frequency':
+        # Fold the source factor into mu: one [rPos, nMod] x [nMod, nFreq * sPos] product
+        weights = (mu[:, :, None] * psi_s[:, None, :]).reshape(n_mod, n_freq * n_src)
+        if out.flags.c_contiguous:
+            np.matmul(psi_r, weights, out=out.reshape(n_rec, n_freq * n_src))
+        else:
+            out[...] = (psi_r @ weights).reshape(n_rec, n_freq, n_src)
+    elif order == 'receiver':
+        # Fold the source factor into psi_r: one [rPos, nMod] x [nMod, nFreq] product per source
+        for s in range(n_src):
+            np.matmul(psi_r * psi_s[:, s], mu, out=out[:, :, s])
+    else:
+        raise ValueError(f"Unknown contraction order '{order}'. Should be 'frequency' or 'receiver'.")
+
+    return out
+
+def contraction_order(n_rec, n_mod, n_freq, n_src):
+    """
+    Pick the cheaper contraction order for modal_sum.
+
+    Both orders cost rPos * nMod * nFreq * sPos multiply-adds in the matrix product, so the
+    choice comes down to which factor is scaled by psi_s beforehand: mu (nMod * nFreq * sPos)
+    or psi_r (rPos * nMod * sPos). Ties go to 'frequency', which needs a single product.
+    """
+    if n_mod * n_freq * n_src <= n_rec * n_mod * n_src:
+        return 'frequency'
+    return 'receiver'
+
+def separable_modal_sum(grid, mu, psi_s, out=None):
+    """
+    Assemble the transfer functions on a rectangular receiver grid without materializing psi_r.
+
+    On the grid the receiver eigenfunctions factor into per-axis cosines,
+    psi_r[iy * xSamples + ix, m] = scale[m] * cos_x[ix, nx[m]] * cos_y[iy, ny[m]], so the modal
+    sum is computed as two small contractions of a coefficient tensor indexed by (nx, ny) with
+    the cosine tables. This costs about (xSamples + ySamples) * nMod * nFreq * sPos instead of
+    rPos * nMod * nFreq * sPos.
+
+    Parameters:
+    - grid: Per-axis factors of the receiver eigenfunctions, as returned by
+      green_3d_freq_modal_response_z0(..., method='separable')
+    - mu: Eigenvalues of the eigenfunctions at each excitation frequency (size = [nMod, nFreq])
+    - psi_s: Eigenfunctions evaluated at source positions (size = [nMod, sPos])
+    - out: Optional output buffer (size = [rPos, nFreq, sPos])
+
+    Returns:
+    - H: Transfer functions between every source and receiver (size = [rPos, nFreq, sPos]),
+      receivers ordered like Setup['Observation']['Point'] (x fastest)
+    """
+    cos_x, cos_y = grid['cos_x'], grid['cos_y']
+    n_x, n_y = len(cos_x), len(cos_y)
+    n_freq = mu.shape[1]
+    n_src = psi_s.shape[1]
+    dtype = np.result_type(cos_x, mu, psi_s)
+
+    if out is None:
+        out = np.empty((n_y * n_x, n_freq, n_src), dtype=dtype)
+    elif out.shape != (n_y * n_x, n_freq, n_src):
+        raise ValueError(f'Output buffer has shape {out.shape}, expected {(n_y * n_x, n_freq, n_src)}.')
+
+    # Modal coefficients on the (nx, ny) lattice; every pair of modal numbers occurs once
+    nx, ny = grid['modal_numbers'][:, 0], grid['modal_numbers'][:, 1]
+    weights = np.zeros((cos_x.shape[1], cos_y.shape[1], n_freq * n_src), dtype=dtype)
+    get_backend().scatter_weights(nx * cos_y.shape[1] + ny, grid['scale'], mu, psi_s,
+                                  weights.reshape(-1, n_freq * n_src))
+
+    # Pick the cheaper of the two contraction orders
+    n_modal_x, n_modal_y = weights.shape[:2]
+    target = out.reshape(n_y, n_x, n_freq * n_src) if out.flags.c_contiguous else None
+    if n_y * n_modal_x * (n_modal_y + n_x) <= n_x * n_modal_y * (n_modal_x + n_y):
+        # [ySamples, ny] x [nx, ny, F * S] -> [nx, ySamples, F * S], then x per grid row
+        partial = np.matmul(cos_y, weights).transpose(1, 0, 2)
+        result = np.matmul(cos_x, partial, out=target)
+    else:
+        # [xSamples, nx] x [nx, ny * F * S] -> [ny, xSamples * F * S], then y in one product
+        partial = (cos_x @ weights.reshape(n_modal_x, -1)).reshape(n_x, n_modal_y, -1)
+        partial = partial.transpose(1, 0, 2).reshape(n_modal_y, -1)
+        result = np.matmul(cos_y, partial, out=None if target is None else target.reshape(n_y, -1))
+
+    if target is None:
+        out[...] = result.reshape(n_y * n_x, n_freq, n_src)
+    return out
+
+def batched_separable_modal_sum(grid, mu, psi_s, out=None):
+    """
+    Assemble the transfer functions of a stack of rooms with the same grid shape.
+
+    The batched counterpart of separable_modal_sum: the coefficient tensors of all rooms are
+    contracted with their cosine tables in stacked matrix products, so the rooms go through
+    a few large BLAS calls instead of one small one per room. Padded modes are skipped.
+
+    Parameters:
+    - grid: Stacked per-axis factors, as returned by green_3d_freq_modal_response_z0_batch
+    - mu: Eigenvalues of the eigenfunctions (size = [nRooms, nMod, nFreq])
+    - psi_s: Eigenfunctions evaluated at source positions (size = [nRooms, nMod, sPos])
+    - out: Optional output buffer (size = [nRooms, rPos, nFreq, sPos])
+
+    Returns:
+    - H: Transfer functions of every room (size = [nRooms, rPos, nFreq, sPos]), receivers
+      ordered like Setup['Observation']['Point'] (x fastest)
+    """
+    cos_x, cos_y, mask = grid['cos_x'], grid['cos_y'], grid['mask']
+    n_rooms, n_x, n_modal_x = cos_x.shape
+    n_y, n_modal_y = cos_y.shape[1:]
+    n_freq, n_src = mu.shape[2], psi_s.shape[2]
+    dtype = np.result_type(cos_x, mu, psi_s)
+
+    if out is None:
+        out = np.empty((n_rooms, n_y * n_x, n_freq, n_src), dtype=dtype)
+    elif out.shape != (n_rooms, n_y * n_x, n_freq, n_src):
+        raise ValueError(f'Output buffer has shape {out.shape}, expected {(n_rooms, n_y * n_x, n_freq, n_src)}.')
+
+    # Modal coefficients of every room on the (nx, ny) lattice, leaving out the padding
+    room, mode = np.nonzero(mask)
+    nx, ny = grid['modal_numbers'][room, mode, 0], grid['modal_numbers'][room, mode, 1]
+    weights = np.zeros((n_rooms, n_modal_x, n_modal_y, n_freq * n_src), dtype=dtype)
+    get_backend().scatter_weights((room * n_modal_x + nx) * n_modal_y + ny, grid['scale'][room, mode],
+                                  mu[room, mode], psi_s[room, mode], weights.reshape(-1, n_freq * n_src))
+
+    # Same contraction orders as separable_modal_sum, with the rooms as the outer stack axis
+    target = out.reshape(n_rooms, n_y, n_x, n_freq * n_src) if out.flags.c_contiguous else None
+    if n_y * n_modal_x * (n_modal_y + n_x) <= n_x * n_modal_y * (n_modal_x + n_y):
+        partial = np.matmul(cos_y[:, None], weights).transpose(0, 2, 1, 3)
+        result = np.matmul(cos_x[:, None], partial, out=target)
+    else:
+        partial = np.matmul(cos_x, weights.reshape(n_rooms, n_modal_x, -1)).reshape(n_rooms, n_x, n_modal_y, -1)
+        partial = partial.transpose(0, 2, 1, 3).reshape(n_rooms, n_modal_y, -1)
+        result = np.matmul(cos_y, partial, out=None if target is None else target.reshape(n_rooms, n_y, -1))
+
+    if target is None:
+        out[...] = result.reshape(n_rooms, n_y * n_x, n_freq, n_src)
+    return out
@@ -0,0 +1,27 @@
+"""
+Kernels of the numba backend (see backend.NumbaBackend). They are kept apart from backend.py,
+which only imports them when the numba backend is selected, as importing numba takes a while.
+"""
+import numba
+import numpy as np
+
+@numba.njit(parallel=True, cache=True)
+def modal_mu_kernel(w, c, km, taum, win_re, win_im, offset, out):
+    for m in numba.prange(out.shape[0]):
+        for f in range(out.shape[1]):
+            k = w[f] / c[m]
+            re = k * k - km[m] * km[m] + offset
+            im = k / (taum[m] * c[m])
+            out[m, f] = -4 * np.pi * (re * win_re[f] - im * win_im[f]) / (re * re + im * im)
+
+@numba.njit(parallel=True, cache=True)
+def scatter_weights_kernel(cells, scale, mu, psi_s, out):
+    n_src = psi_s.shape[1]
+    for m in numba.prange(len(cells)):
+        for f in range(mu.shape[1]):
+            value = scale[m] * mu[m, f]
+            for s in range(n_src):
+                out[cells[m], f * n_src + s] = value * psi_s[m, s]
+
+def set_num_threads(threads):
+    numba.set_num_threads(max(1, min(threads, numba.config.NUMBA_NUM_THREADS)))
@@ -0,0 +1,139 @@
+import numpy as np
+from init import ambient
+from green_3d_freq_modal_response import enumerate_modes, grid_factors, modal_factors_z0, modal_mu_z0, select_modes_z0
+from modal_sum import separable_modal_sum
+from dataset_store import DatasetWriter, compact_setup
+from graph_edges import grid_edges
+from room_response import RoomResponse
+from telemetry import Telemetry
+
+def parameter_sweep(setup, freq_lim=400, reverb_times=None, temperatures=None, source_positions=None,
+                    bins=None, margin=None, lazy=False, telemetry=None):
+    """
+    Solve variants of one room geometry over a grid of reverberation times, ambient
+    temperatures and source positions, reusing the work that only depends on the geometry.
+
+    The modes of all variants are enumerated once, for the lowest speed of sound of the sweep
+    (which has the most modes below freq_lim), together with the cosine tables of the grid and
+    the source eigenfunctions. Each variant then takes its own modes from this table; mu is
+    evaluated once per reverberation time and temperature, and psi_s is reused across them. The
+    results equal those of green_3d_freq_modal_response_z0(..., method='separable') per variant.
+
+    Parameters:
+    - setup: Base setup dictionary; its grid is shared by all variants
+    - freq_lim: Highest eigenfunction resonance frequency included in the calculations
+    - reverb_times: Reverberation times [s] to sweep (default: that of setup)
+    - temperatures: Ambient temperatures [deg C] to sweep, at the ambient pressure of setup
+      (default: that of setup)
+    - source_positions: Source positions to sweep, each a position [x, y, z] or a list of
+      positions (default: those of setup)
+    - bins: Optional indices of the solution frequencies to evaluate (see frequency_bins)
+    - margin: If given, only modes resonating within margin [Hz] of the evaluated frequencies
+      are included
+    - lazy: Yield a RoomResponse per variant instead of the assembled responses
+    - telemetry: Optional Telemetry receiving the stage events
+
+    Yields:
+    - variant: Dictionary with the 'ReverbTime', 'Temp' and 'Source' (index into
+      source_positions) of the variant
+    - Setup: Setup dictionary of the variant
+    - frequency_response: Transfer functions on the observation grid
+      (size = [ySamples, xSamples, nFreq, sPos]), or the RoomResponse of the variant if lazy
+    """
+    if telemetry is None:
+        telemetry = Telemetry()
+    reverb_times = [setup['Room']['ReverbTime']] if reverb_times is None else list(reverb_times)
+    temperatures = [setup['Ambient']['Temp']] if temperatures is None else list(temperatures)
+    if source_positions is None:
+        source_positions = [setup['Source']['Position']]
+    source_positions = [np.atleast_2d(np.asarray(positions, dtype=float)).tolist() for positions in source_positions]
+    ambients = [ambient(temp, setup['Ambient']['Pressure']) for temp in temperatures]
+    dims = setup['Room']['Dim']
+
+    # Superset of the modes of all variants, and the factors that only depend on the geometry
+    with telemetry.stage('mode_enumeration') as record:
+        modes = enumerate_modes(freq_lim, dims[:2], min(Ambient['c'] for Ambient in ambients))
+        modal_numbers, scale, _ = modal_factors_z0(setup, modes)
+        grid = grid_factors(setup, modal_numbers, scale)
+        record['modes'] = len(modes)
+
+    # Position of each (nx, ny) pair in the superset
+    lattice = np.full((grid['cos_x'].shape[1], grid['cos_y'].shape[1]), -1)
+    lattice[modal_numbers[:, 0], modal_numbers[:, 1]] = np.arange(len(modes))
+
+    with telemetry.stage('sources', sources=len(source_positions)):
+        psi_s = [modal_factors_z0(setup, modes, sources=positions)[2] for positions in source_positions]
+
+    y_samples, x_samples = setup['Observation']['ySamples'], setup['Observation']['xSamples']
+    for temp, Ambient in zip(temperatures, ambients):
+        for reverb_time in reverb_times:
+            room_setup = {**setup, 'Ambient': Ambient, 'Room': {**setup['Room'], 'ReverbTime': reverb_time}}
+            with telemetry.stage('solver', method='sweep'):
+                variant_modes = select_modes_z0(freq_lim, room_setup, bins, margin, modes=modes)
+                index = lattice[variant_modes['nx'], variant_modes['ny']]
+                variant_numbers = modal_numbers[index]
+                variant_grid = {'cos_x': grid['cos_x'][:, :variant_numbers[:, 0].max(initial=0) + 1],
+                                'cos_y': grid['cos_y'][:, :variant_numbers[:, 1].max(initial=0) + 1],
+                                'modal_numbers': variant_numbers,
+                                'scale': scale[index]}
+                mu = modal_mu_z0(room_setup, variant_modes, bins)
+
+            for source, positions in enumerate(source_positions):
+                Setup = {**room_setup, 'Source': {**setup['Source'], 'Position': positions, 'SrcNum': len(positions)}}
+                variant = {'ReverbTime': reverb_time, 'Temp': temp, 'Source': source}
+                if lazy:
+                    yield variant, Setup, RoomResponse(Setup, variant_grid, mu, psi_s[source][index], bins=bins)
+                    continue
+                with telemetry.stage('modal_sum', method='separable') as record:
+                    frequency_response = separable_modal_sum(variant_grid, mu, psi_s[source][index])
+                    record['tensor_bytes'] = frequency_response.nbytes
+                yield variant, Setup, frequency_response.reshape(y_samples, x_samples, *frequency_response.shape[1:])
+
+def save_sweep(setup, output='sweep', storage='native', connectivity=4, telemetry=None, freq_lim=400,
+               bins=None, margin=None, **axes):
+    """
+    Run parameter_sweep and stream every variant to a dataset store as it is computed.
+
+    Parameters:
+    - setup: Base setup dictionary
+    - output: Directory of the dataset store
+    - storage: Storage format of the frequency responses (see create_dataset)
+    - connectivity: Neighbours of each receiver in the stored grid graph, 4 or 8
+    - telemetry: Optional Telemetry receiving per-stage and per-variant events
+    - freq_lim, bins, margin, axes: Passed on to parameter_sweep (reverb_times,
+      temperatures, source_positions)
+
+    Returns:
+    - count: Number of variants written
+    """
+    if telemetry is None:
+        telemetry = Telemetry()
+    x_samples, y_samples = setup['Observation']['xSamples'], setup['Observation']['ySamples']
+    count = 0
+    with DatasetWriter(output, storage=storage) as writer:
+        edges = writer.add_edges(f'grid_{y_samples}x{x_samples}_{connectivity}', grid_edges(x_samples, y_samples, connectivity))
+        for variant, Setup, frequency_response in parameter_sweep(setup, freq_lim, bins=bins, margin=margin,
+                                                                  lazy=storage == 'factorized', telemetry=telemetry, **axes):
+            if not isinstance(frequency_response, RoomResponse):
+                frequency_response = frequency_response.reshape(x_samples * y_samples, *frequency_response.shape[2:])
+                if frequency_response.shape[2] == 1:
+                    frequency_response = frequency_response[:, :, 0]
+            with telemetry.stage('save'):
+                writer.append(f'Variant{count + 1}', frequency_response,
+                              variant=variant,
+                              edges=edges,
+                              freq_lim=freq_lim,
+                              margin=margin,
+                              bins=bins,
+                              Setup=compact_setup(Setup))
+            telemetry.room_done(count, **variant)
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    from init import create_setup
+
+    Setup = create_setup(seed=1)
+    count = save_sweep(Setup, reverb_times=[0.3, 0.6, 1.0], temperatures=[10, 20, 30])
+    print(f"Wrote {count} variants")
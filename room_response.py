@@ -0,0 +1,113 @@
+from collections import OrderedDict
+import numpy as np
+from green_3d_freq_modal_response import green_3d_freq_modal_response_z0, eigenfunctions, frequency_bins
+from modal_sum import modal_sum, separable_modal_sum
+
+class RoomResponse:
+    """
+    Lazily evaluated frequency responses of one room in the z = 0 plane.
+
+    Only the compact factors of the modal decomposition are kept: the per-axis cosine tables of
+    the observation grid with the mode table, mu and psi_s. Responses are computed for the
+    requested receivers and frequency bins only, and the full [rPos, nFreq, sPos] tensor is never
+    built unless dense() is called. The most recently evaluated blocks are kept in a small LRU.
+
+    Parameters:
+    - setup: Dictionary containing the configuration and parameters
+    - grid: Per-axis factors of the receiver eigenfunctions (see green_3d_freq_modal_response_z0)
+    - mu: Eigenvalues of the eigenfunctions at each evaluated frequency (size = [nMod, nFreq])
+    - psi_s: Eigenfunctions evaluated at source positions (size = [nMod, sPos])
+    - bins: Indices of the solution frequencies mu was evaluated at, or None for all of them
+    - cache_size: Number of evaluated blocks kept
+    """
+
+    def __init__(self, setup, grid, mu, psi_s, bins=None, cache_size=16):
+        self.setup = setup
+        self.grid = grid
+        self.mu = mu
+        self.psi_s = psi_s
+        self.bins = bins
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    @property
+    def shape(self):
+        return (len(self.grid['cos_x']) * len(self.grid['cos_y']), self.mu.shape[1], self.psi_s.shape[1])
+
+    @property
+    def frequency(self):
+        frequency = np.arange(0, self.setup['Fs'] / 2, 1 / self.setup['Duration'])
+        return frequency if self.bins is None else frequency[self.bins]
+
+    def __getitem__(self, key):
+        """
+        Responses H[receivers, freqs] at grid receivers, numbered like Setup['Observation']['Point'].
+
+        Both indices may be slices, integers or index arrays; integers keep their axis. The result
+        (size = [nReceivers, nFreq, sPos]) is read-only, as it may be shared with the cache.
+        """
+        receivers, freqs = key if isinstance(key, tuple) else (key, slice(None))
+        cache_key = (_hashable(receivers), _hashable(freqs))
+        if cache_key in self._cache:
+            self._cache.move_to_end(cache_key)
+            return self._cache[cache_key]
+
+        receivers = np.arange(self.shape[0])[receivers] if isinstance(receivers, slice) else np.atleast_1d(receivers)
+        freqs = freqs if isinstance(freqs, slice) else np.atleast_1d(freqs)
+        x_samples = len(self.grid['cos_x'])
+        nx, ny = self.grid['modal_numbers'][:, 0], self.grid['modal_numbers'][:, 1]
+        psi_r = (self.grid['scale'] * self.grid['cos_x'][receivers % x_samples][:, nx]
+                 * self.grid['cos_y'][receivers // x_samples][:, ny])
+        block = modal_sum(psi_r, self.mu[:, freqs], self.psi_s)
+        block.setflags(write=False)
+
+        if self.cache_size > 0:
+            self._cache[cache_key] = block
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return block
+
+    def at(self, points, freqs=slice(None)):
+        """
+        Responses at arbitrary (off-grid) positions in the room.
+
+        Parameters:
+        - points: Receiver positions [x, y] or [x, y, z] (size = [nPoints, 2 or 3])
+        - freqs: Slice, integer or indices of the evaluated frequency bins
+
+        Returns:
+        - H: Transfer functions (size = [nPoints, nFreq, sPos])
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        freqs = freqs if isinstance(freqs, slice) else np.atleast_1d(freqs)
+        psi_r = eigenfunctions(points[:, :2], self.grid['modal_numbers'], self.setup['Room']['Dim'][:2], self.grid['scale'])
+        return modal_sum(psi_r, self.mu[:, freqs], self.psi_s)
+
+    def dense(self):
+        """
+        Full tensor of responses at all grid receivers (size = [rPos, nFreq, sPos]).
+        """
+        return separable_modal_sum(self.grid, self.mu, self.psi_s)
+
+def room_response_z0(freq_lim, setup, band=None, margin=None, cache_size=16):
+    """
+    Solve the modal decomposition of a room and return its lazily evaluated responses.
+
+    Parameters:
+    - freq_lim: Highest eigenfunction resonance frequency included in the calculations
+    - setup: Dictionary containing the configuration and parameters
+    - band: Optional band limits [f_min, f_max] in Hz to restrict the frequencies to
+    - margin: If given, only modes resonating within margin [Hz] of the band are included
+    - cache_size: Number of evaluated blocks kept
+
+    Returns:
+    - response: RoomResponse of the room
+    """
+    bins = frequency_bins(setup, band=band)
+    grid, mu, psi_s = green_3d_freq_modal_response_z0(freq_lim, setup, method='separable', bins=bins, margin=margin)
+    return RoomResponse(setup, grid, mu, psi_s, bins=bins, cache_size=cache_size)
+
+def _hashable(index):
+    if isinstance(index, slice):
+        return ('slice', index.start, index.stop, index.step)
+    return tuple(np.atleast_1d(index).tolist())
@@ -0,0 +1,118 @@
+import numpy as np
+
+# Storage formats of the frequency responses in the dataset store
+STORAGE_FORMATS = ('native', 'complex64', 'magphase16', 'db16')
+
+# Dynamic range [dB] below the peak magnitude kept by the 'db16' format
+DB_RANGE = 120.0
+
+def encode_response(frequency_response, storage='native'):
+    """
+    Encode frequency responses for storage. The responses are always computed in double
+    precision; only the stored representation changes.
+
+    The solvers compute real-valued float64 responses (mu is real); complex128 input is
+    supported as well. Formats (stored size relative to the computed dtype, typical error for a
+    32 x 32 grid room, see storage_error_report):
+    - 'native': Stored as computed, lossless
+    - 'complex64': Single precision (float32 for real-valued responses), 1/2 of the computed
+      size, relative RMS error ~2e-8
+    - 'magphase16': Real responses are stored as float16, normalized by the peak magnitude,
+      1/4 of float64, relative RMS error ~2e-4. Complex responses are stored as the normalized
+      magnitude and the phase as float16 along a trailing axis of size 2, 1/4 of complex128,
+      relative RMS error ~2e-4, < 0.005 dB
+    - 'db16': Magnitude in dB quantized to int16 over DB_RANGE below the peak, 1/4 of float64
+      and 1/8 of complex128, magnitude error < 0.002 dB. The phase (or sign) is discarded
+
+    Parameters:
+    - frequency_response: Array of frequency responses
+    - storage: One of STORAGE_FORMATS
+
+    Returns:
+    - data: Array to store
+    - params: JSON-serializable parameters needed to decode data
+    """
+    frequency_response = np.asarray(frequency_response)
+    params = {'format': storage}
+    if storage == 'native':
+        data = frequency_response
+    elif storage == 'complex64':
+        data = frequency_response.astype(np.complex64 if np.iscomplexobj(frequency_response) else np.float32)
+    elif storage == 'magphase16':
+        magnitude = np.abs(frequency_response)
+        scale = float(magnitude.max()) or 1.0
+        if np.iscomplexobj(frequency_response):
+            data = np.stack([magnitude / scale, np.angle(frequency_response)], axis=-1).astype(np.float16)
+        else:
+            # The phase of a real response is 0 or pi, so the signed value is stored instead
+            data = (frequency_response / scale).astype(np.float16)
+            params['signed'] = True
+        params['scale'] = scale
+    elif storage == 'db16':
+        magnitude = np.abs(frequency_response)
+        peak_db = 20 * np.log10(magnitude.max()) if magnitude.max() > 0 else 0.0
+        step = DB_RANGE / np.iinfo(np.int16).max
+        with np.errstate(divide='ignore'):
+            level = 20 * np.log10(magnitude) - peak_db
+        data = np.round(np.clip(level, -DB_RANGE, 0) / step).astype(np.int16)
+        params.update({'peak_db': float(peak_db), 'step': step})
+    else:
+        raise ValueError(f"Unknown storage format '{storage}'. Should be one of {STORAGE_FORMATS}.")
+    params['dtype'] = frequency_response.dtype.str
+    return data, params
+
+def decode_response(data, params):
+    """
+    Decode (a slice along the leading axes of) stored frequency responses.
+
+    Returns:
+    - frequency_response: Decoded array. 'native' data is returned as is, without a copy; the
+      other formats are decoded to the computed dtype ('db16' gives the magnitude only)
+    """
+    storage = params['format']
+    if storage == 'native':
+        return data
+    dtype = np.dtype(params['dtype'])
+    if storage == 'complex64':
+        return data.astype(dtype)
+    if storage == 'magphase16':
+        if params.get('signed'):
+            return data.astype(np.float64) * params['scale']
+        magnitude = data[..., 0].astype(np.float64) * params['scale']
+        phase = data[..., 1].astype(np.float64)
+        if np.iscomplexobj(np.empty(0, dtype)):
+            return magnitude * np.exp(1j * phase)
+        return magnitude * np.cos(phase)
+    if storage == 'db16':
+        magnitude = 10 ** ((data * params['step'] + params['peak_db']) / 20)
+        magnitude[data <= -np.iinfo(np.int16).max] = 0
+        return magnitude
+    raise ValueError(f"Unknown storage format '{storage}'. Should be one of {STORAGE_FORMATS}.")
+
+def storage_error_report(frequency_response):
+    """
+    Error of every storage format against the double-precision reference.
+
+    Returns:
+    - report: Dictionary per format with the stored size relative to the reference, the
+      maximum absolute error, the RMS error relative to the RMS of the reference, and the
+      largest magnitude error in dB over bins within 60 dB of the peak
+    """
+    reference = np.asarray(frequency_response)
+    rms = np.sqrt(np.mean(np.abs(reference) ** 2))
+    magnitude = np.abs(reference)
+    significant = magnitude > magnitude.max() * 1e-3
+    report = {}
+    for storage in STORAGE_FORMATS:
+        data, params = encode_response(reference, storage)
+        decoded = decode_response(data, params)
+        # db16 keeps the magnitude only, so it is compared against the reference magnitude
+        target = magnitude if storage == 'db16' else reference
+        error = np.abs(decoded - target)
+        with np.errstate(divide='ignore'):
+            db_error = np.abs(20 * np.log10(np.abs(decoded[significant]) / magnitude[significant]))
+        report[storage] = {'size_ratio': data.nbytes / reference.nbytes,
+                           'max_abs_error': float(error.max()),
+                           'rel_rms_error': float(np.sqrt(np.mean(error ** 2)) / rms),
+                           'max_db_error': float(db_error.max()) if db_error.size else 0.0}
+    return report
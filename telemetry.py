@@ -0,0 +1,98 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+class Telemetry:
+    """
+    Per-stage and per-room instrumentation of the dataset generation.
+
+    Every stage (e.g. mode enumeration, solver, modal sum, save) and every finished room emits
+    one event dictionary. Events are appended to a JSONL trace, passed to the callbacks and,
+    with keep_events=True, collected in `events`.
+
+    Parameters:
+    - path: Optional JSONL file the events are appended to
+    - callbacks: Functions called with every event
+    - total: Number of rooms to generate, used for the ETA
+    - keep_events: Collect the events in memory
+    """
+
+    def __init__(self, path=None, callbacks=(), total=None, keep_events=False):
+        self.callbacks = list(callbacks)
+        self.total = total
+        self.events = [] if keep_events else None
+        self.rooms_done = 0
+        self.room = None
+        self._start = time.perf_counter()
+        self._trace = open(path, 'a') if path is not None else None
+
+    @contextmanager
+    def stage(self, name, **info):
+        """
+        Time a stage of the current room. Fields added to the yielded dictionary, such as the
+        number of modes or tensor bytes, are included in the event.
+        """
+        record = dict(info)
+        start = time.perf_counter()
+        yield record
+        self.emit({'event': 'stage', 'stage': name, 'room': self.room,
+                   'wall_time': time.perf_counter() - start, 'peak_rss': peak_rss(), **record})
+
+    def room_done(self, room, **info):
+        """
+        Record a finished room and its throughput, rooms/second and ETA so far.
+        """
+        self.rooms_done += 1
+        self.emit({'event': 'room', 'room': room, 'rooms_done': self.rooms_done,
+                   'elapsed': time.perf_counter() - self._start, 'rooms_per_second': self.rooms_per_second,
+                   'eta': self.eta, 'peak_rss': peak_rss(), **info})
+
+    @property
+    def rooms_per_second(self):
+        elapsed = time.perf_counter() - self._start
+        return self.rooms_done / elapsed if elapsed > 0 else None
+
+    @property
+    def eta(self):
+        """
+        Estimated seconds until all rooms are done, or None if unknown.
+        """
+        rate = self.rooms_per_second
+        if not rate or self.total is None:
+            return None
+        return (self.total - self.rooms_done) / rate
+
+    def emit(self, event):
+        if self.events is not None:
+            self.events.append(event)
+        if self._trace is not None:
+            self._trace.write(json.dumps(event) + '\n')
+            self._trace.flush()
+        for callback in self.callbacks:
+            callback(event)
+
+    def close(self):
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def peak_rss():
+    """
+    Peak resident set size of the process in bytes, or None where it is not available.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024